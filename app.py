@@ -1,56 +1,389 @@
-from flask import Flask
+import base64
+import csv
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, partial, wraps
+from itertools import chain
+
+import click
+from flask import (Blueprint, Flask, Response, abort, current_app, g, has_request_context, request, send_file,
+                   stream_with_context)
 from flask_restx import Api, Resource, fields
 from flask_sqlalchemy import SQLAlchemy
-from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///students.db'  # change this to your database connection string
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['JWT_SECRET_KEY'] = 'secret'  # change this to your secret key
-
-db = SQLAlchemy(app)
-jwt = JWTManager(app)
-api = Api(app)
+from sqlalchemy import bindparam, case, event, func, inspect, literal, or_, select, text, union_all
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.types import TypeDecorator
+from werkzeug.http import http_date
+from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt, get_jwt_identity
+from flask_jwt_extended.config import config as jwt_config
+
+from cache import LocalCache, SQLiteCache
+from compression import COMPRESSIBLE, compress, compress_stream, negotiate
+from groupcommit import GroupCommitter
+from hashing import HashPoolBusy, PasswordHasher
+from jobs import JobLost, JobQueue
+from metrics import RequestMetrics, StackSampler, write_folded
+from ratelimit import SharedTokenBuckets
+from serialization import dumps, json_response, loads
+
+
+def database_uri():
+    uri = os.environ.get('DATABASE_URL', 'sqlite:///students.db')
+    if uri.startswith('mysql://'):
+        uri = 'mysql+mysqlconnector://' + uri[len('mysql://'):]  # the driver shipped in requirements.txt
+    return uri
+
+
+def engine_options(uri):
+    if uri.startswith('sqlite'):
+        return {}  # SQLite tuning happens in set_sqlite_pragmas()
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),  # below MySQL's wait_timeout
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets gunicorn workers read while one of them writes, NORMAL syncs at checkpoints only
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA foreign_keys=ON')  # off by default in SQLite, the ON DELETE CASCADEs rely on it
+    cursor.execute(f'PRAGMA busy_timeout={int(os.environ.get("DB_BUSY_TIMEOUT", 5000))}')
+    cursor.close()
+
+
+def configure(app):
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri()
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['JWT_SECRET_KEY'] = 'secret'  # change this to your secret key
+    app.config['PROPAGATE_EXCEPTIONS'] = True  # lets flask-jwt-extended answer token errors instead of flask-restx 500s
+    app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'local')  # 'sqlite' shares entries between workers
+    app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 60))  # 0 effectively disables caching
+    app.config['CACHE_MAX_ENTRIES'] = 1024
+    app.config['PASSWORD_HASH_ITERATIONS'] = 260000  # existing hashes are upgraded on the next login
+    app.config['PASSWORD_HASH_WORKERS'] = 2
+    app.config['PASSWORD_HASH_MAX_PENDING'] = 2  # box-wide, keep below the gunicorn worker count
+    app.config['JWT_VERIFIED_CACHE_SIZE'] = 4096
+    app.config['API_DOCS'] = os.environ.get('API_DOCS', '1') == '1'  # Swagger UI at / and /swagger.json
+    # 'fts5' needs SQLite built with FTS5, 'tokens' works anywhere; run `flask rebuild-search` after switching
+    app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'auto')
+    # deleting a student or course tombstones it and its grades instead, `flask purge-deleted` removes them later
+    app.config['SOFT_DELETE'] = os.environ.get('SOFT_DELETE', '0') == '1'
+    app.config['PURGE_AFTER_HOURS'] = float(os.environ.get('PURGE_AFTER_HOURS', 24 * 7))
+    app.config['PURGE_BATCH_SIZE'] = 500  # ids per IN clause, keep within SQLite's bound-parameter limit
+    # /changes leaves out entries younger than this many seconds; SQLite commits writers in seq order, but on MySQL
+    # a transaction can commit after one holding a later seq, so set this above the longest write transaction there
+    app.config['CHANGE_FEED_DELAY'] = float(os.environ.get('CHANGE_FEED_DELAY', 0))
+    # grade writes from concurrent request threads (gthread workers) share one commit per window, 0 turns it off
+    app.config['GROUP_COMMIT_WINDOW_MS'] = float(os.environ.get('GROUP_COMMIT_WINDOW_MS', 0))
+    # token buckets per caller and endpoint as (requests per second, burst); /login and /register are keyed on the
+    # client address, everything else on the JWT identity; None exempts an endpoint
+    app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+    app.config['RATE_LIMIT_DEFAULT'] = (20, 40)
+    app.config['RATE_LIMITS'] = {
+        'login': (0.5, 10),
+        'register': (0.1, 5),
+        'grades_bulk': (1, 5),
+        'transcripts': (0.1, 2),
+        'cohort_analytics': (1, 5),
+        'job_submit': (0.5, 10),
+        'prometheus_metrics': None,
+    }
+    # background jobs, run by `flask run-jobs`; results are kept for JOB_RETENTION_HOURS after finishing
+    app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+    app.config['JOB_POLL_INTERVAL'] = 1.0
+    app.config['JOB_RETENTION_HOURS'] = float(os.environ.get('JOB_RETENTION_HOURS', 24))
+    # responses of COMPRESSION_MIN_SIZE bytes or more, and streamed ones, go out as brotli (when installed) or gzip,
+    # whichever the client accepts
+    app.config['COMPRESSION_ENABLED'] = os.environ.get('COMPRESSION_ENABLED', '1') == '1'
+    app.config['COMPRESSION_MIN_SIZE'] = 1024
+    app.config['COMPRESSION_LEVELS'] = {'br': 4, 'gzip': 6}
+    # sampling profiler, off unless a threshold is set; slow requests are dumped as folded stacks
+    app.config['PROFILE_THRESHOLD_MS'] = int(os.environ['PROFILE_THRESHOLD_MS']) if 'PROFILE_THRESHOLD_MS' in os.environ else None
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 1.0))
+    app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+
+
+class CachingJWTManager(JWTManager):
+    # remembers tokens whose signature was already checked, until they expire
+    def init_app(self, app, add_context_processor=False):
+        self.verified = LocalCache(max_entries=app.config['JWT_VERIFIED_CACHE_SIZE'])
+        super().init_app(app, add_context_processor)
+
+    def _decode_jwt_from_config(self, encoded_token, csrf_value=None, allow_expired=False):
+        if csrf_value is not None or allow_expired:
+            return super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+        key = hashlib.sha256(encoded_token.encode()).digest()
+        claims = self.verified.get(key)
+        if claims is None:
+            claims = super()._decode_jwt_from_config(encoded_token)
+            if 'exp' in claims:
+                self.verified.set(key, claims, ttl=claims['exp'] - time.time())
+        return dict(claims)
+
+    def identity(self, encoded_token):
+        # the identity of a valid token or None, without the header and request parsing of verify_jwt_in_request()
+        try:
+            claims = self._decode_jwt_from_config(encoded_token)
+        except Exception:
+            return None
+        return claims.get(jwt_config.identity_claim_key) if claims.get('type') == 'access' else None
+
+
+db = SQLAlchemy()
+jwt = CachingJWTManager()
+api = Api()
+api.representation('application/json')(json_response)
+# request hooks and CLI commands, registered on the app by create_app()
+server = Blueprint('server', __name__, cli_group=None)
+
+
+def make_cache(app):
+    if app.config['CACHE_BACKEND'] == 'sqlite':
+        os.makedirs(app.instance_path, exist_ok=True)
+        return SQLiteCache(os.path.join(app.instance_path, 'cache.db'), app.config['CACHE_TTL'],
+                           app.config['CACHE_MAX_ENTRIES'])
+    return LocalCache(app.config['CACHE_TTL'], app.config['CACHE_MAX_ENTRIES'])
+
+
+BUSY_RESPONSE = {'message': 'Server busy, try again shortly'}, 503, {'Retry-After': '1'}
+ADDRESS_LIMITED = {'login', 'register'}
+RATE_LIMITED = {'message': 'Too many requests, try again later'}
+
+
+def group_commit_connection(app):
+    with app.app_context():
+        connection = db.engine.connect()
+    if connection.dialect.name == 'sqlite':
+        # a grouped commit is synced before any of its writers is answered, the fsync is shared by the group
+        connection.exec_driver_sql('PRAGMA synchronous=FULL')
+    return connection
+
+
+# built by create_app(); each opens its files, threads and connections per process, so `gunicorn --preload`
+# can create them in the master before forking
+cache = hasher = buckets = committer = jobs = None
+
+
+def init_services(app):
+    global cache, hasher, buckets, committer, jobs
+    cache = make_cache(app)
+    hasher = PasswordHasher(os.path.join(app.instance_path, 'hash-slots'), app.config['PASSWORD_HASH_ITERATIONS'],
+                            app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_MAX_PENDING'])
+    buckets = SharedTokenBuckets(os.path.join(app.instance_path, 'ratelimit.buckets'))
+    committer = GroupCommitter(partial(group_commit_connection, app), app.config['GROUP_COMMIT_WINDOW_MS'] / 1000) \
+        if app.config['GROUP_COMMIT_WINDOW_MS'] else None
+    jobs = JobQueue(os.path.join(app.instance_path, 'jobs.db'), os.path.join(app.instance_path, 'job-results'))
+
+
+def run_write(unit, *args):
+    # unit(connection, *args) runs in a transaction that is committed before this returns; in group commit
+    # mode that transaction is shared with the writes other request threads made in the same window
+    if committer is not None:
+        return committer.submit(unit, *args)
+    result = unit(db.session.connection(), *args)
+    db.session.commit()
+    return result
+
+
+metrics = RequestMetrics()
+sampler = StackSampler()
+
+
+# the start time rides on the statement's execution context, so one that fails leaves nothing behind;
+# the few dialect-internal statements run without a context go unmeasured
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.statement_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'statement_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+        g.sql_seconds += elapsed
+    elif 'sql_totals' in conn.info:
+        # a request on asgi.py's fast path, counted on the connection it checked out
+        conn.info['sql_totals'][0] += 1
+        conn.info['sql_totals'][1] += elapsed
+
+
+@server.before_app_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+    config = current_app.config
+    if config['PROFILE_THRESHOLD_MS'] is not None and random.random() < config['PROFILE_SAMPLE_RATE']:
+        sampler.start(threading.get_ident())
+        g.profiled = True
+
+
+def rate_limit_caller():
+    authorization = request.headers.get('Authorization', '')
+    if request.endpoint not in ADDRESS_LIMITED and authorization.startswith('Bearer '):
+        # only picks the bucket, the view's @jwt_required() still answers a bad token
+        identity = jwt.identity(authorization[len('Bearer '):])
+        if identity is not None:
+            return f'user:{identity}'
+    return f'addr:{request.remote_addr}'
+
+
+def rate_limit_wait(config, endpoint, caller):
+    # caller() names who is asking, 'user:<identity>' or 'addr:<address>'; returns 0 when a token was taken,
+    # otherwise the seconds until the caller's bucket for endpoint holds one again. Shared with asgi.py
+    if not config['RATE_LIMIT_ENABLED']:
+        return 0
+    budget = config['RATE_LIMITS'].get(endpoint, config['RATE_LIMIT_DEFAULT'])
+    if budget is None:
+        return 0
+    return buckets.take(f'{endpoint}:{caller()}', *budget)
+
+
+@server.before_app_request
+def rate_limit():
+    if request.endpoint is None:
+        return
+    wait = rate_limit_wait(current_app.config, request.endpoint, rate_limit_caller)
+    if wait:
+        return json_response(RATE_LIMITED, 429, {'Retry-After': str(math.ceil(wait))})
+
+
+@server.after_app_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.request_started
+    metrics.observe(request.endpoint or 'unmatched', request.method, response.status_code, elapsed,
+                    g.sql_statements, g.sql_seconds, response.content_length)
+    return response
+
+
+@server.after_app_request
+def compress_response(response):
+    # registered after record_request_metrics, so it runs first and the metrics count the bytes sent
+    config = current_app.config
+    if not config['COMPRESSION_ENABLED'] or response.status_code != 200 or response.direct_passthrough \
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE:
+        return response
+    if not response.is_streamed and len(response.get_data()) < config['COMPRESSION_MIN_SIZE']:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+    levels = config['COMPRESSION_LEVELS']
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, levels, response.charset)
+    else:
+        response.set_data(compress(response.get_data(), encoding, levels))
+    response.content_encoding = encoding
+    return response
+
+
+@server.teardown_app_request
+def finish_profile(error=None):
+    if not g.get('profiled'):
+        return
+    stacks = sampler.stop(threading.get_ident())
+    elapsed_ms = (time.perf_counter() - g.request_started) * 1000
+    if stacks and elapsed_ms >= current_app.config['PROFILE_THRESHOLD_MS']:
+        write_folded(current_app.config['PROFILE_DIR'], f'{request.endpoint or "unmatched"}-{int(elapsed_ms)}ms',
+                     stacks)
+
+
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
-    password = db.Column(db.String(100), nullable=False)
+    password = db.Column(db.String(255), nullable=False)
     role = db.Column(db.String(10), nullable=False)  # either 'student' or 'teacher'
 
     def __repr__(self):
         return f'<User {self.username}>'
 
 
-class Student(db.Model):
+class Rounded(TypeDecorator):
+    """A float stored exact and read back through Python's round(), which rounds halves to even."""
+    impl = db.Float
+    cache_ok = True
+
+    def __init__(self, digits):
+        super().__init__()
+        self.digits = digits
+
+    def process_result_value(self, value, dialect):
+        return round(value, self.digits) if value is not None else None
+
+
+class Tombstoned:
+    # set instead of deleting the row in SOFT_DELETE mode, reads leave such rows out through live()
+    deleted_at = db.Column(db.DateTime, index=True)
+
+
+class Student(Tombstoned, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), nullable=False)
+    name = db.Column(db.String(50), index=True, nullable=False)
     email = db.Column(db.String(50), unique=True, nullable=False)
-    courses = db.relationship('Course', secondary='student_course', backref='students')
+    # GPA totals are kept up to date by the grade write handlers, see adjust_gpa(); SQL's ROUND() takes
+    # halves away from zero, so the GPA is stored unrounded and rounded on read
+    gpa = db.Column(Rounded(2))
+    total_points = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    total_credits = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # passive_deletes: the database cascades deletes to grades and enrollments, the ORM never loads them
+    courses = db.relationship('Course', secondary='student_course', passive_deletes=True,
+                              backref=db.backref('students', passive_deletes=True))
 
     def __repr__(self):
         return f'<Student {self.name}>'
 
 
-class Course(db.Model):
+class Course(Tombstoned, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), nullable=False)
-    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    name = db.Column(db.String(50), unique=True, index=True, nullable=False)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True, nullable=False)
     teacher = db.relationship('User', backref='courses')
-    grades = db.relationship('Grade', backref='course')
+    grades = db.relationship('Grade', backref='course', passive_deletes=True)
 
     def __repr__(self):
         return f'<Course {self.name}>'
 
 
-class Grade(db.Model):
+class Grade(Tombstoned, db.Model):
+    # unique index enforces one grade per student and course, and serves lookups by student_id;
+    # the score indexes serve ?min_score=/?max_score= and ?sort=score on /grades, with or without ?course_id=
+    __table_args__ = (db.Index('ix_grade_student_course', 'student_id', 'course_id', unique=True),
+                      db.Index('ix_grade_course_score', 'course_id', 'score'))
+
     id = db.Column(db.Integer, primary_key=True)
-    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
-    student = db.relationship('Student', backref='grades')
-    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
-    score = db.Column(db.Float, nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id', ondelete='CASCADE'), nullable=False)
+    student = db.relationship('Student', backref=db.backref('grades', passive_deletes=True))
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id', ondelete='CASCADE'), index=True, nullable=False)
+    score = db.Column(db.Float, index=True, nullable=False)
 
     def __repr__(self):
         return f'<Grade {self.student.name} - {self.course.name} - {self.score}>'
@@ -58,10 +391,434 @@ class Grade(db.Model):
 
 # association table for many-to-many relationship between students and courses
 student_course = db.Table('student_course',
-                          db.Column('student_id', db.Integer, db.ForeignKey('student.id')),
-                          db.Column('course_id', db.Integer, db.ForeignKey('course.id'))
+                          db.Column('student_id', db.Integer, db.ForeignKey('student.id', ondelete='CASCADE'),
+                                    primary_key=True),
+                          db.Column('course_id', db.Integer, db.ForeignKey('course.id', ondelete='CASCADE'),
+                                    primary_key=True),
+                          db.Index('ix_student_course_course_id', 'course_id')
                           )
 
+# prefix-search fallback: one row per lowercased word of a student's or course's name and email
+search_token = db.Table('search_token',
+                        db.Column('token', db.String(50), primary_key=True),
+                        db.Column('kind', db.String(10), primary_key=True),
+                        db.Column('ref_id', db.Integer, primary_key=True),
+                        db.Index('ix_search_token_ref', 'kind', 'ref_id')
+                        )
+
+# change feed: one row per write to a student, course, grade or enrollment, added in the writer's transaction;
+# sqlite_autoincrement keeps SQLite from reusing the seq of a removed last row
+change_log = db.Table('change_log',
+                      db.Column('seq', db.Integer, primary_key=True),
+                      db.Column('entity', db.String(10), nullable=False),
+                      db.Column('op', db.String(6), nullable=False),  # 'insert', 'update' or 'delete'
+                      db.Column('data', db.Text, nullable=False),  # JSON of the row as written, only its key on deletes
+                      db.Column('changed_at', db.DateTime, nullable=False, default=datetime.utcnow),
+                      sqlite_autoincrement=True
+                      )
+
+# a write counter per change feed entity, bumped in the transaction of every change logged for it; the read
+# endpoints derive their ETag and Last-Modified from the counters of what they read, see cached()
+table_version = db.Table('table_version',
+                         db.Column('name', db.String(10), primary_key=True),
+                         db.Column('version', db.Integer, nullable=False),
+                         db.Column('modified_at', db.DateTime, nullable=False)
+                         )
+VERSIONED = ('student', 'course', 'grade', 'enrollment')
+
+
+@event.listens_for(table_version, 'after_create')
+def seed_table_versions(target, connection, **kw):
+    now = datetime.utcnow()
+    connection.execute(table_version.insert(), [{'name': name, 'version': 0, 'modified_at': now}
+                                                for name in VERSIONED])
+
+
+# search index: SQLite FTS5 tables kept in sync by triggers, or search_token kept in sync by mapper events
+SEARCH_COLUMNS = {'student': ('name', 'email'), 'course': ('name',)}
+
+
+@lru_cache(maxsize=None)
+def sqlite_has_fts5():
+    try:
+        sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE probe USING fts5(text)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def search_backend(dialect):
+    backend = current_app.config['SEARCH_BACKEND']
+    if backend == 'auto':
+        return 'fts5' if dialect.name == 'sqlite' and sqlite_has_fts5() else 'tokens'
+    return backend
+
+
+def tokenize(value):
+    return re.findall(r'\w+', value.lower()) if value else []
+
+
+def fts5_ddl(table, columns):
+    new = ', '.join(f'new.{column}' for column in columns)
+    old = ', '.join(f'old.{column}' for column in columns)
+    names = ', '.join(columns)
+    insert = f'INSERT INTO {table}_fts(rowid, {names}) VALUES (new.id, {new});'
+    delete = f"INSERT INTO {table}_fts({table}_fts, rowid, {names}) VALUES ('delete', old.id, {old});"
+    # external content: the FTS table indexes the rows of `table` without storing a second copy of them
+    return [
+        f"CREATE VIRTUAL TABLE {table}_fts USING fts5({names}, content='{table}', content_rowid='id', prefix='2 3 4 5 6 7 8')",
+        f'CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN {insert} END',
+        f'CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN {delete} END',
+        f'CREATE TRIGGER {table}_fts_update AFTER UPDATE OF {names} ON {table} BEGIN {delete} {insert} END',
+        f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')",
+    ]
+
+
+def index_tokens(connection, kind, ref_id, values):
+    connection.execute(search_token.delete().where(search_token.c.kind == kind, search_token.c.ref_id == ref_id))
+    tokens = {token[:50] for value in values for token in tokenize(value)}
+    if tokens:
+        connection.execute(search_token.insert(), [{'token': token, 'kind': kind, 'ref_id': ref_id}
+                                                   for token in tokens])
+
+
+def create_search_index(connection):
+    if search_backend(connection.dialect) == 'fts5':
+        for table, columns in SEARCH_COLUMNS.items():
+            for statement in fts5_ddl(table, columns):
+                connection.exec_driver_sql(statement)
+        return
+    for kind, columns in SEARCH_COLUMNS.items():
+        table = db.metadata.tables[kind]
+        connection.execute(search_token.delete().where(search_token.c.kind == kind))
+        rows = connection.execute(select(table.c.id, *(table.c[column] for column in columns)))
+        while True:
+            batch = rows.fetchmany(STREAM_BATCH_SIZE)
+            if not batch:
+                break
+            connection.execute(search_token.insert(), [
+                {'token': token, 'kind': kind, 'ref_id': row[0]}
+                for row in batch for token in {token[:50] for value in row[1:] for token in tokenize(value)}
+            ])
+
+
+def drop_search_index(connection):
+    if connection.dialect.name == 'sqlite':
+        for table in SEARCH_COLUMNS:
+            for trigger in ('insert', 'delete', 'update'):
+                connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS {table}_fts_{trigger}')
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS {table}_fts')
+
+
+@event.listens_for(db.metadata, 'after_create')
+def search_index_after_create(target, connection, tables=(), **kw):
+    # also runs for create_all() on an existing database, as in upgrade-db, indexing the rows already there
+    if search_backend(connection.dialect) == 'fts5':
+        if not inspect(connection).has_table('student_fts'):
+            create_search_index(connection)
+    elif search_token in tables:
+        create_search_index(connection)
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def search_index_before_drop(target, connection, **kw):
+    drop_search_index(connection)
+
+
+def sync_search_tokens(mapper, connection, target):
+    if search_backend(connection.dialect) == 'tokens':
+        kind = mapper.local_table.name
+        index_tokens(connection, kind, target.id, [getattr(target, column) for column in SEARCH_COLUMNS[kind]])
+
+
+def drop_search_tokens(mapper, connection, target):
+    if search_backend(connection.dialect) == 'tokens':
+        connection.execute(search_token.delete().where(search_token.c.kind == mapper.local_table.name,
+                                                       search_token.c.ref_id == target.id))
+
+
+for model in (Student, Course):
+    event.listen(model, 'after_insert', sync_search_tokens)
+    event.listen(model, 'after_update', sync_search_tokens)
+    event.listen(model, 'after_delete', drop_search_tokens)
+
+
+# what the change feed carries per entity; Core writes call record_changes() themselves, ORM flushes go
+# through log_row_change()
+CHANGE_FIELDS = {
+    'student': ('id', 'name', 'email'),
+    'course': ('id', 'name', 'teacher_id'),
+    'grade': ('id', 'student_id', 'course_id', 'score'),
+}
+
+
+def record_changes(entity, op, rows, connection=None):
+    # rows: dicts of CHANGE_FIELDS values, or of the key alone for deletes; written in the caller's transaction
+    params = [{'entity': entity, 'op': op, 'data': dumps(row).decode()} for row in rows]
+    if params:
+        (connection or db.session).execute(change_log.insert(), params)
+        bump_versions([entity], connection)
+
+
+def bump_versions(names, connection=None):
+    stmt = table_version.update().where(table_version.c.name.in_(names)) \
+        .values(version=table_version.c.version + 1, modified_at=datetime.utcnow())
+    (connection or db.session).execute(stmt)
+
+
+def log_row_change(op, mapper, connection, target):
+    entity = mapper.local_table.name
+    fields = ('id',) if op == 'delete' else CHANGE_FIELDS[entity]
+    record_changes(entity, op, [{field: getattr(target, field) for field in fields}], connection)
+
+
+for model in (Student, Course, Grade):
+    for op in ('insert', 'update', 'delete'):
+        event.listen(model, f'after_{op}', partial(log_row_change, op))
+
+
+# standard 4.0 scale, each course counts as one credit
+GRADE_SCALE = ((90, 4.0, 'A'), (80, 3.0, 'B'), (70, 2.0, 'C'), (60, 1.0, 'D'))
+FAILING_LETTER = 'F'
+
+
+def grade_points(score):
+    for cutoff, points, _ in GRADE_SCALE:
+        if score >= cutoff:
+            return points
+    return 0.0
+
+
+def grade_letter(score):
+    for cutoff, _, letter in GRADE_SCALE:
+        if score >= cutoff:
+            return letter
+    return FAILING_LETTER
+
+
+def grade_points_sql(score):
+    return case(*((score >= cutoff, points) for cutoff, points, _ in GRADE_SCALE), else_=0.0)
+
+
+def adjust_gpa(changes, connection=None):
+    # changes: iterable of (student_id, points delta, credits delta), applied in the caller's transaction
+    table = Student.__table__
+    points = table.c.total_points + bindparam('points')
+    credits = table.c.total_credits + bindparam('credits')
+    stmt = table.update().where(table.c.id == bindparam('student')).values(
+        total_points=points,
+        total_credits=credits,
+        gpa=case((credits > 0, points / credits), else_=None)
+    )
+    params = [{'student': student_id, 'points': points_delta, 'credits': credits_delta}
+              for student_id, points_delta, credits_delta in changes]
+    if params:
+        (connection or db.session).execute(stmt, params)
+
+
+def recompute_gpa():
+    grades = Grade.__table__
+    table = Student.__table__
+    owned = (grades.c.student_id == table.c.id) & grades.c.deleted_at.is_(None)
+    points = grade_points_sql(grades.c.score)
+    db.session.execute(table.update().values(
+        total_points=select(func.coalesce(func.sum(points), 0.0)).where(owned).scalar_subquery(),
+        total_credits=select(func.count()).where(owned).scalar_subquery(),
+        gpa=select(func.avg(points)).where(owned).scalar_subquery()
+    ))
+    bump_versions(['student'])
+
+
+@server.cli.command('rebuild-gpa')
+def rebuild_gpa():
+    """Recompute every student's GPA totals in one aggregate UPDATE."""
+    recompute_gpa()
+    db.session.commit()
+    click.echo('GPA rebuilt')
+
+
+@server.cli.command('rebuild-search')
+def rebuild_search():
+    """Rebuild the search index from the student and course tables."""
+    connection = db.session.connection()
+    drop_search_index(connection)
+    create_search_index(connection)
+    db.session.commit()
+    click.echo(f'Search index rebuilt ({search_backend(connection.dialect)})')
+
+
+# deletes: hard deletes rely on ON DELETE CASCADE for grades and enrollments; in SOFT_DELETE mode a student or
+# course and its grades are tombstoned instead, and purge-deleted removes them once PURGE_AFTER_HOURS have passed
+def live(*models):
+    if not current_app.config['SOFT_DELETE']:
+        return ()
+    return tuple(model.deleted_at.is_(None) for model in models)
+
+
+# a tombstone gives up its unique key, so a new or renamed row can take it before purge-deleted runs
+TOMBSTONED_KEYS = {Student: Student.__table__.c.email, Course: Course.__table__.c.name}
+
+
+def tombstone(model, id, grades=None):
+    now = datetime.utcnow()
+    values = {'deleted_at': now}
+    key = TOMBSTONED_KEYS.get(model)
+    if key is not None:
+        # '~<id>~' first keeps the rewritten key unique however much of the old one still fits the column
+        values[key.name] = func.substr(f'~{id}~' + key, 1, key.type.length)
+    db.session.execute(model.__table__.update().where(model.id == id).values(values))
+    record_changes(model.__tablename__, 'delete', [{'id': id}])
+    if grades is not None:
+        db.session.execute(Grade.__table__.update().where(grades, Grade.deleted_at.is_(None)).values(deleted_at=now))
+
+
+def release_grade_keys(pairs, connection=None):
+    # ix_grade_student_course counts tombstoned grades too, so the one holding a (student_id, course_id) pair a
+    # grade is written to goes now rather than at purge time; its delete is already on the change feed
+    table = Grade.__table__
+    stmt = table.delete().where(table.c.student_id == bindparam('student'), table.c.course_id == bindparam('course'),
+                                table.c.deleted_at.isnot(None))
+    params = [{'student': student_id, 'course': course_id} for student_id, course_id in pairs]
+    if params:
+        (connection or db.session).execute(stmt, params)
+
+
+def record_dependents(grade_ids, enrollments):
+    # what a student or course delete takes with it, cascaded or tombstoned, never passes through the ORM
+    record_changes('grade', 'delete', [{'id': grade_id} for grade_id in grade_ids])
+    record_changes('enrollment', 'delete', [{'student_id': student_id, 'course_id': course_id}
+                                            for student_id, course_id in enrollments])
+
+
+def purge_enrollments(column, other, id, batch_size):
+    # one course can have any number of students, so its enrollments go in batches as well
+    while True:
+        others = [value for value, in db.session.query(other).filter(column == id).limit(batch_size)]
+        if not others:
+            return
+        db.session.execute(student_course.delete().where(column == id, other.in_(others)))
+        db.session.commit()
+
+
+def purge_batch(model, cutoff, batch_size):
+    ids = [id for id, in db.session.query(model.id).filter(model.deleted_at < cutoff).limit(batch_size)]
+    if model is Student:
+        for id in ids:
+            purge_enrollments(student_course.c.student_id, student_course.c.course_id, id, batch_size)
+    elif model is Course:
+        for id in ids:
+            purge_enrollments(student_course.c.course_id, student_course.c.student_id, id, batch_size)
+    if ids:
+        connection = db.session.connection()
+        if model is not Grade and search_backend(connection.dialect) == 'tokens':
+            # Core deletes skip the mapper events that keep search_token in sync, FTS5 has its own triggers
+            connection.execute(search_token.delete().where(search_token.c.kind == model.__tablename__,
+                                                           search_token.c.ref_id.in_(ids)))
+        connection.execute(model.__table__.delete().where(model.id.in_(ids)))
+    db.session.commit()
+    return len(ids)
+
+
+@server.cli.command('purge-deleted')
+@click.option('--older-than', type=float, help='Hours since deletion, defaults to PURGE_AFTER_HOURS.')
+@click.option('--batch-size', type=int, help='Rows per transaction, defaults to PURGE_BATCH_SIZE.')
+def purge_deleted(older_than, batch_size):
+    """Remove tombstoned grades, students and courses in bounded batches, one transaction each."""
+    config = current_app.config
+    hours = config['PURGE_AFTER_HOURS'] if older_than is None else older_than
+    cutoff = datetime.utcnow() - timedelta(hours=hours)
+    batch_size = batch_size or config['PURGE_BATCH_SIZE']
+    # grades first, so removing a student or course leaves the cascade nothing to do
+    for model in (Grade, Student, Course):
+        purged = 0
+        while True:
+            count = purge_batch(model, cutoff, batch_size)
+            purged += count
+            if count < batch_size:
+                break
+        click.echo(f'Purged {purged} {model.__tablename__} rows')
+
+
+# schema changes made after the first release; create_all() only creates missing tables
+GPA_COLUMNS = (Student.__table__.c.gpa, Student.__table__.c.total_points, Student.__table__.c.total_credits)
+ADDED_COLUMNS = GPA_COLUMNS + tuple(model.__table__.c.deleted_at for model in (Student, Course, Grade))
+WIDENED_COLUMNS = (User.__table__.c.password,)  # VARCHAR(100) at first, too short for the current hashes
+UNIQUE_KEYS = (('course', ('name',)), ('grade', ('student_id', 'course_id')), ('student_course', ('student_id', 'course_id')))
+
+
+def duplicate_count(table, columns):
+    keys = ', '.join(columns)
+    return db.session.execute(text(f'SELECT count(*) FROM (SELECT {keys} FROM {table} '
+                                   f'GROUP BY {keys} HAVING count(*) > 1) AS dupes')).scalar()
+
+
+def missing_cascade(inspector, table):
+    return any((key['options'].get('ondelete') or '').upper() != 'CASCADE'
+               for key in inspector.get_foreign_keys(table) if key['referred_table'] in ('student', 'course'))
+
+
+def narrower_columns(inspector):
+    # WIDENED_COLUMNS still shorter in the database than in the models; SQLite never enforces VARCHAR lengths
+    if inspector.dialect.name == 'sqlite':
+        return []
+    narrower = []
+    for column in WIDENED_COLUMNS:
+        current = {existing['name']: existing['type'] for existing in inspector.get_columns(column.table.name)}
+        if (getattr(current[column.name], 'length', None) or 0) < column.type.length:
+            narrower.append(column)
+    return narrower
+
+
+def rebuild_table(table):
+    # neither SQLite nor portable DDL can add a primary key or change a foreign key in place, so copy into a new table
+    db.session.execute(text(f'ALTER TABLE {table.name} RENAME TO {table.name}_old'))
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite':
+        # SQLite index names are global and the renamed table keeps its indexes
+        for index in inspect(connection).get_indexes(f'{table.name}_old'):
+            db.session.execute(text(f'DROP INDEX {index["name"]}'))
+    table.create(connection)
+    columns = ', '.join(column.name for column in table.columns)
+    db.session.execute(text(f'INSERT INTO {table.name} ({columns}) SELECT DISTINCT {columns} FROM {table.name}_old'))
+    db.session.execute(text(f'DROP TABLE {table.name}_old'))
+
+
+@server.cli.command('upgrade-db')
+def upgrade_db():
+    """Bring an existing database up to the current models: columns, indexes and keys."""
+    db.create_all()
+    inspector = inspect(db.engine)
+
+    for table, columns in UNIQUE_KEYS:
+        if table != 'student_course' and duplicate_count(table, columns):
+            raise click.ClickException(f'{table} has duplicate {", ".join(columns)} rows, resolve them first')
+
+    existing = {table: {column['name'] for column in inspector.get_columns(table)}
+                for table in {column.table.name for column in ADDED_COLUMNS}}
+    missing = [column for column in ADDED_COLUMNS if column.name not in existing[column.table.name]]
+    for column in missing:
+        ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+        db.session.execute(text(f'ALTER TABLE {column.table.name} ADD COLUMN {ddl}'))
+    for column in narrower_columns(inspector):
+        ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+        db.session.execute(text(f'ALTER TABLE {column.table.name} MODIFY {ddl}'))
+
+    if not inspector.get_pk_constraint('student_course')['constrained_columns'] \
+            or missing_cascade(inspector, 'student_course'):
+        rebuild_table(student_course)
+    if missing_cascade(inspector, 'grade'):
+        rebuild_table(Grade.__table__)
+
+    connection = db.session.connection()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+    if any(column in missing for column in GPA_COLUMNS):
+        recompute_gpa()
+    db.session.commit()
+    click.echo('Database upgraded')
+
 # from flask_jwt_extended import create_access_token
 # from flask_restx import fields, Resource
 # from werkzeug.security import generate_password_hash, check_password_hash
@@ -91,7 +848,10 @@ class Register(Resource):
         if User.query.filter_by(username=username).first():
             return {'message': 'Username already exists'}, 400
 
-        hashed_password = generate_password_hash(password)
+        try:
+            hashed_password = hasher.hash(password)
+        except HashPoolBusy:
+            return BUSY_RESPONSE
 
         user = User(username=username, password=hashed_password, role=role)
 
@@ -99,6 +859,9 @@ class Register(Resource):
             db.session.add(user)
             db.session.commit()
             return {'message': 'User registered successfully'}, 201
+        except IntegrityError:
+            db.session.rollback()
+            return {'message': 'Username already exists'}, 400
         except:
             return {'message': 'Something went wrong'}, 500
 
@@ -117,10 +880,20 @@ class Login(Resource):
 
         user = User.query.filter_by(username=username).first()
 
-        if not user or not check_password_hash(user.password, password):
-            return {'message': 'Invalid credentials'}, 401
+        try:
+            if not user or not hasher.check(user.password, password):
+                return {'message': 'Invalid credentials'}, 401
+        except HashPoolBusy:
+            return BUSY_RESPONSE
 
-        access_token = create_access_token(identity=user.id)
+        if hasher.needs_rehash(user.password):
+            try:
+                user.password = hasher.hash(password)
+                db.session.commit()
+            except HashPoolBusy:
+                pass  # keep the old hash, it will be upgraded on a later login
+
+        access_token = create_access_token(identity=user.id, additional_claims={'role': user.role})
 
         return {'access_token': access_token}, 200
 
@@ -142,6 +915,10 @@ course_model = api.model('Course', {
     'teacher_id': fields.Integer(required=True)
 })
 
+enrollment_model = api.model('Enrollment', {
+    'student_ids': fields.List(fields.Integer, required=True)
+})
+
 grade_model = api.model('Grade', {
     'student_id': fields.Integer(required=True),
     'course_id': fields.Integer(required=True),
@@ -149,13 +926,322 @@ grade_model = api.model('Grade', {
 })
 
 
+def teacher_role(teacher_id):
+    # the caller's own role is in the token, any other user costs one column lookup
+    role = get_jwt().get('role') if teacher_id == get_jwt_identity() else None
+    if role is None:
+        role = db.session.query(User.role).filter_by(id=teacher_id).first_or_404().role
+    return role
+
+
+def cache_tags(*tags):
+    g.setdefault('cache_tags', set()).update(tags)
+
+
+def versions_select(names):
+    return select(table_version.c.name, table_version.c.version, table_version.c.modified_at) \
+        .where(table_version.c.name.in_(names))
+
+
+def validators(rows):
+    # rows: (name, version, modified_at) of the tables a response is built from. The ETag is weak, the body is
+    # the same compressed or not. Last-Modified is left out while the last write is under a second old: HTTP
+    # dates can't tell it apart from another write later in that second
+    rows = sorted(rows)
+    etag = hashlib.sha1(','.join(f'{name}:{version}' for name, version, _ in rows).encode()).hexdigest()[:20]
+    modified = max(row[2] for row in rows).replace(tzinfo=timezone.utc) if rows else None
+    if modified is not None and datetime.now(timezone.utc) - modified < timedelta(seconds=1):
+        return etag, None
+    return etag, modified and modified.replace(microsecond=0)
+
+
+def not_modified(etag, modified, if_none_match, if_modified_since):
+    # If-None-Match wins over If-Modified-Since when a client sends both
+    if if_none_match:
+        return if_none_match.contains_weak(etag)
+    return modified is not None and if_modified_since is not None and modified <= if_modified_since
+
+
+def validator_headers(etag, modified):
+    # no-cache: clients revalidate every time instead of guessing a freshness lifetime from Last-Modified
+    headers = {'ETag': f'W/"{etag}"', 'Cache-Control': 'private, no-cache'}
+    if modified is not None:
+        headers['Last-Modified'] = http_date(modified)
+    return headers
+
+
+def cached(*tables):
+    # caches 200 JSON responses under the request URL, tagged with what the handler read. tables, or a function
+    # of the query string returning them, are what the response is built from: their version counters answer
+    # a matching conditional GET with a 304 before the handler runs, and retire cache entries built before
+    # their last write, whichever worker made it
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            names = tables[0](request.args) if callable(tables[0]) else tables
+            etag, modified = validators(db.session.execute(versions_select(names)))
+            headers = validator_headers(etag, modified)
+            if not_modified(etag, modified, request.if_none_match, request.if_modified_since):
+                return Response(status=304, headers=headers)
+            key = request.full_path
+            entry = cache.get(key)
+            if entry is None or entry[0] != etag:
+                rv = fn(*args, **kwargs)
+                if isinstance(rv, Response):
+                    # streamed listings
+                    if rv.status_code == 200:
+                        rv.headers.update(headers)
+                    return rv
+                if rv[1] != 200:
+                    return rv
+                entry = [etag, dumps(rv[0]).decode(), rv[2] if len(rv) > 2 else {}]
+                cache.set(key, entry, g.get('cache_tags', ()))
+            _, body, extra = entry
+            return Response(body, mimetype='application/json', headers=dict(extra, **headers))
+
+        return wrapper
+
+    return decorator
+
+
+def student_listing_tables(args):
+    # GPAs move with every grade write, so grades only count when ?fields= asks for them
+    tables = ['student']
+    if 'course_id' in args or 'teacher_id' in args:
+        tables += ['enrollment', 'course']
+    if 'gpa' in args.get('fields', '').split(','):
+        tables.append('grade')
+    return tables
+
+
+def course_listing_tables(args):
+    return ['course', 'enrollment'] if 'student_id' in args else ['course']
+
+
+def grade_rows():
+    # one JOIN projection instead of lazy-loading grade.student / grade.course per row
+    return db.session.query(Grade.id, Student.name.label('student'), Course.name.label('course'), Grade.score,
+                            Grade.student_id, Grade.course_id) \
+        .join(Student, Grade.student_id == Student.id) \
+        .join(Course, Grade.course_id == Course.id) \
+        .filter(*live(Grade))
+
+
+def serialize_grade(grade):
+    # positional, so it takes both Rows and the plain tuples from fetch_rows(): (id, student, course, score, ...)
+    return {
+        'student': grade[1],
+        'course': grade[2],
+        'score': grade[3]
+    }
+
+
+# keyset pagination: listings are ordered by id, or by ?sort=[-]<column> with id as the tie-breaker,
+# and resumed with ?after=<X-Next-After of the previous page>
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+
+
+def page_args():
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def listing_args(available, sortable):
+    fields = request.args.get('fields')
+    if fields is not None:
+        fields = fields.split(',')
+        if not all(name in available for name in fields):
+            api.abort(400, f'Invalid fields, expected any of: {", ".join(available)}')
+    sort = request.args.get('sort', 'id')
+    if sort.lstrip('-') not in sortable:
+        api.abort(400, f'Invalid sort, expected one of: {", ".join(sortable)}')
+    return fields, available[sort.lstrip('-')], sort.startswith('-')
+
+
+def encode_cursor(keys):
+    if len(keys) == 1:
+        return str(keys[0])
+    return base64.urlsafe_b64encode(dumps(list(keys))).decode()
+
+
+def decode_cursor(value, size):
+    if value is None:
+        return None
+    try:
+        keys = (int(value),) if size == 1 else json.loads(base64.urlsafe_b64decode(value))
+    except ValueError:
+        keys = None
+    # anything that decodes is client input: a list of the right length, of values the columns can hold
+    if not isinstance(keys, (list, tuple)) or len(keys) != size \
+            or not all(key is None or isinstance(key, (str, int, float)) for key in keys):
+        api.abort(400, 'Invalid after cursor')
+    return tuple(keys)
+
+
+def fetch_rows(query):
+    # plain DBAPI tuples for listings: skips ORM loading and Row construction, which cost more than the SQL;
+    # the columns whose type converts what the driver hands back, such as Rounded, are still converted
+    statement = query.statement
+    connection = db.session.connection()
+    dialect = connection.dialect
+    processors = [(index, processor) for index, processor in enumerate(
+        column.type.dialect_impl(dialect).result_processor(dialect, None) for column in statement.selected_columns)
+        if processor is not None]
+    result = connection.execute(statement)
+    try:
+        rows = result.cursor.fetchall()
+    finally:
+        result.close()
+    if not processors:
+        return rows
+    converted = []
+    for row in rows:
+        row = list(row)
+        for index, processor in processors:
+            row[index] = processor(row[index])
+        converted.append(tuple(row))
+    return converted
+
+
+def seek(query, keys, descending, after):
+    # keys is (id,) or (sort column, id), after holds their values on the last row served
+    if after is None:
+        return query
+    if len(keys) == 1:
+        return query.filter(keys[0] < after[0] if descending else keys[0] > after[0])
+    (column, id_column), (value, last_id) = keys, after
+    # the leading range term lets the database seek into the sort index instead of scanning it from the start
+    if descending:
+        return query.filter(column <= value, or_(column < value, id_column < last_id))
+    return query.filter(column >= value, or_(column > value, id_column > last_id))
+
+
+def keyset_page(query, keys, descending, after, limit):
+    # rows are tuples starting with the key values
+    return fetch_rows(seek(query, keys, descending, after).limit(limit))
+
+
+def iter_keyset(query, keys, descending, after, batch_size=STREAM_BATCH_SIZE):
+    # one bounded SELECT per batch, so memory stays flat however big the table is
+    while True:
+        rows = keyset_page(query, keys, descending, after, batch_size)
+        if not rows:
+            return
+        yield from rows
+        after = rows[-1][:len(keys)]
+
+
+def stream_listing(rows, serialize, fmt):
+    if fmt == 'ndjson':
+        def generate():
+            for row in rows:
+                yield dumps(serialize(row)) + b'\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    def generate():
+        yield b'['
+        separator = b''
+        for row in rows:
+            yield separator + dumps(serialize(row))
+            separator = b','
+        yield b']'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def paginate(query, available, sortable, default_fields, serialize=None):
+    # available maps ?fields= names to columns; without ?fields= rows are the default_fields values,
+    # passed to serialize or zipped into a dict
+    fields, sort_column, descending = listing_args(available, sortable)
+    limit = page_args()
+    fmt = request.args.get('stream')
+
+    keys = (available['id'],) if sort_column is available['id'] else (sort_column, available['id'])
+    after = decode_cursor(request.args.get('after'), len(keys))
+    names = fields or default_fields
+    query = query.with_entities(*keys, *(available[name] for name in names)) \
+        .order_by(*(key.desc() if descending else key for key in keys))
+
+    offset = len(keys)
+    if fields or serialize is None:
+        def serialize_row(row):
+            return dict(zip(names, row[offset:]))
+    else:
+        def serialize_row(row):
+            return serialize(row[offset:])
+
+    if fmt:
+        if fmt not in ('ndjson', 'json'):
+            return {'message': 'Invalid stream format'}, 400
+        return stream_listing(iter_keyset(query, keys, descending, after), serialize_row, fmt)
+
+    rows = keyset_page(query, keys, descending, after, limit)
+    headers = {}
+    if len(rows) == limit:
+        headers['X-Next-After'] = encode_cursor(rows[-1][:offset])
+    return [serialize_row(row) for row in rows], 200, headers
+
+
+# what each listing can return with ?fields= and order by with ?sort=, every sort column is indexed
+STUDENT_FIELDS = {'id': Student.id, 'name': Student.name, 'email': Student.email, 'gpa': Student.gpa}
+STUDENT_SORTS = ('id', 'name', 'email')
+COURSE_FIELDS = {'id': Course.id, 'name': Course.name, 'teacher_id': Course.teacher_id}
+COURSE_SORTS = ('id', 'name', 'teacher_id')
+GRADE_FIELDS = {'id': Grade.id, 'student': Student.name, 'course': Course.name, 'score': Grade.score,
+                'student_id': Grade.student_id, 'course_id': Grade.course_id}
+GRADE_SORTS = ('id', 'score', 'course_id')
+# query-string filters on /grades and the grades export job: (name, type, condition)
+GRADE_FILTERS = (
+    ('student_id', int, lambda value: Grade.student_id == value),
+    ('course_id', int, lambda value: Grade.course_id == value),
+    ('teacher_id', int, lambda value: Course.teacher_id == value),
+    ('min_score', float, lambda value: Grade.score >= value),
+    ('max_score', float, lambda value: Grade.score <= value),
+)
+
+
+def grade_filters(args):
+    filters = {}
+    for name, type_, _ in GRADE_FILTERS:
+        value = args.get(name, type=type_)
+        if value is not None:
+            filters[name] = value
+    return filters
+
+
+def filter_grades(query, filters):
+    for name, _, condition in GRADE_FILTERS:
+        if filters.get(name) is not None:
+            query = query.filter(condition(filters[name]))
+    return query
+
+
 @api.route('/students')
 class Students(Resource):
 
     @jwt_required()
+    @cached(student_listing_tables)
     def get(self):
-        students = Student.query.all()
-        return [student.name for student in students], 200
+        query = db.session.query(Student).filter(*live(Student))
+        tags = ['students']
+        course_id = request.args.get('course_id', type=int)
+        teacher_id = request.args.get('teacher_id', type=int)
+        if course_id is not None:
+            query = query.filter(Student.id.in_(
+                select(student_course.c.student_id).where(student_course.c.course_id == course_id)))
+            tags.append(f'course:{course_id}')
+        if teacher_id is not None:
+            query = query.filter(Student.id.in_(
+                select(student_course.c.student_id).join(Course)
+                .where(Course.teacher_id == teacher_id, *live(Course))))
+            tags += ['courses', 'enrollments']
+        if 'gpa' in request.args.get('fields', '').split(','):
+            tags.append('grades')  # grade writes move the GPA without touching 'students'
+        cache_tags(*tags)
+        return paginate(query, STUDENT_FIELDS, STUDENT_SORTS, ['name'], lambda values: values[0])
 
     @api.expect(student_model)
     @jwt_required()
@@ -167,30 +1253,36 @@ class Students(Resource):
         if not name or not email:
             return {'message': 'Missing name or email'}, 400
 
-        if Student.query.filter_by(email=email).first():
-            return {'message': 'Email already exists'}, 400
-
         student = Student(name=name, email=email)
 
         try:
             db.session.add(student)
             db.session.commit()
+            cache.invalidate('students')
             return {'message': 'Student created successfully'}, 201
+        except IntegrityError:
+            db.session.rollback()
+            return {'message': 'Email already exists'}, 400
         except:
             return {'message': 'Something went wrong'}, 500
 
 
 @api.route('/students/<int:id>')
-class Student(Resource):
+class StudentDetail(Resource):
 
     @jwt_required()
+    @cached('student', 'enrollment', 'course', 'grade')
     def get(self, id):
-        student = Student.query.get_or_404(id)
+        student = db.session.query(Student.name, Student.email, Student.gpa) \
+            .filter(Student.id == id, *live(Student)).first_or_404()
+        courses = db.session.query(Course.id, Course.name).join(student_course) \
+            .filter(student_course.c.student_id == id, *live(Course)).all()
+        cache_tags(f'student:{id}', *(f'course:{course.id}' for course in courses))
         return {
                    'name': student.name,
                    'email': student.email,
-                   'courses': [course.name for course in student.courses],
-                   'gpa': self.calculate_gpa(student.grades)
+                   'courses': [course.name for course in courses],
+                   'gpa': student.gpa
                }, 200
 
     @api.expect(student_model)
@@ -203,100 +1295,106 @@ class Student(Resource):
         if not name or not email:
             return {'message': 'Missing name or email'}, 400
 
-        student = Student.query.get_or_404(id)
-
-        if Student.query.filter_by(email=email).first() and email != student.email:
-            return {'message': 'Email already exists'}, 400
+        student = Student.query.filter(Student.id == id, *live(Student)).first_or_404()
 
         student.name = name
         student.email = email
 
         try:
             db.session.commit()
+            cache.invalidate(f'student:{id}', 'students')
             return {'message': 'Student updated successfully'}, 200
+        except IntegrityError:
+            db.session.rollback()
+            return {'message': 'Email already exists'}, 400
         except:
             return {'message': 'Something went wrong'}, 500
 
     @jwt_required()
     def delete(self, id):
-        student = Student.query.get_or_404(id)
+        student = Student.query.filter(Student.id == id, *live(Student)).first_or_404()
+        # enrollments with a tombstoned course left the change feed with that course
+        course_ids = {course_id for course_id, in db.session.query(student_course.c.course_id).join(Course)
+                      .filter(student_course.c.student_id == id, *live(Course))}
+        grade_ids = [grade_id for grade_id, in db.session.query(Grade.id)
+                     .filter(Grade.student_id == id, *live(Grade)).order_by(Grade.id)]
         try:
-            db.session.delete(student)
+            record_dependents(grade_ids, ((id, course_id) for course_id in course_ids))
+            if current_app.config['SOFT_DELETE']:
+                tombstone(Student, id, Grade.student_id == id)
+            else:
+                db.session.delete(student)
             db.session.commit()
+            cache.invalidate(f'student:{id}', 'students', 'grades', 'enrollments',
+                             *(f'course:{course_id}' for course_id in course_ids))
             return {'message': 'Student deleted successfully'}, 200
         except:
             return {'message': 'Something went wrong'}, 500
 
-    def calculate_gpa(self, grades):
-        # use the standard 4.0 scale for calculating GPA
-        total_points = 0
-        total_credits = 0
-        for grade in grades:
-            score = grade.score
-            if score >= 90:
-                points = 4.0
-            elif score >= 80:
-                points = 3.0
-            elif score >= 70:
-                points = 2.0
-            elif score >= 60:
-                points = 1.0
-            else:
-                points = 0.0
-            total_points += points
-            total_credits += 1  # assume each course has one credit
-        if total_credits == 0:
-            return None  # no grades available
-        else:
-            return round(total_points / total_credits, 2)
-
-    @api.route('/courses')
-    class Courses(Resource):
 
-        @jwt_required()
-        def get(self):
-            courses = Course.query.all()
-            return [course.name for course in courses], 200
+@api.route('/courses')
+class Courses(Resource):
 
-        @api.expect(course_model)
-        @jwt_required()
-        def post(self):
-            data = api.payload
-            name = data.get('name')
-            teacher_id = data.get('teacher_id')
-
-            if not name or not teacher_id:
-                return {'message': 'Missing name or teacher_id'}, 400
+    @jwt_required()
+    @cached(course_listing_tables)
+    def get(self):
+        query = db.session.query(Course).filter(*live(Course))
+        tags = ['courses']
+        teacher_id = request.args.get('teacher_id', type=int)
+        student_id = request.args.get('student_id', type=int)
+        if teacher_id is not None:
+            query = query.filter(Course.teacher_id == teacher_id)
+        if student_id is not None:
+            query = query.filter(Course.id.in_(
+                select(student_course.c.course_id).where(student_course.c.student_id == student_id)))
+            tags.append(f'student:{student_id}')
+        cache_tags(*tags)
+        return paginate(query, COURSE_FIELDS, COURSE_SORTS, ['name'], lambda values: values[0])
 
-            if Course.query.filter_by(name=name).first():
-                return {'message': 'Course already exists'}, 400
+    @api.expect(course_model)
+    @jwt_required()
+    def post(self):
+        data = api.payload
+        name = data.get('name')
+        teacher_id = data.get('teacher_id')
 
-            teacher = User.query.get_or_404(teacher_id)
+        if not name or not teacher_id:
+            return {'message': 'Missing name or teacher_id'}, 400
 
-            if teacher.role != 'teacher':
-                return {'message': 'Invalid teacher_id'}, 400
+        if teacher_role(teacher_id) != 'teacher':
+            return {'message': 'Invalid teacher_id'}, 400
 
-            course = Course(name=name, teacher_id=teacher_id)
+        course = Course(name=name, teacher_id=teacher_id)
 
-            try:
-                db.session.add(course)
-                db.session.commit()
-                return {'message': 'Course created successfully'}, 201
-            except:
-                return {'message': 'Something went wrong'}, 500
+        try:
+            db.session.add(course)
+            db.session.commit()
+            cache.invalidate('courses')
+            return {'message': 'Course created successfully'}, 201
+        except IntegrityError:
+            db.session.rollback()
+            return {'message': 'Course already exists'}, 400
+        except:
+            return {'message': 'Something went wrong'}, 500
 
 
 @api.route('/courses/<int:id>')
-class Course(Resource):
+class CourseDetail(Resource):
 
     @jwt_required()
+    @cached('course', 'enrollment', 'student', 'grade')
     def get(self, id):
-        course = Course.query.get_or_404(id)
+        course = db.session.query(Course.name, User.username).join(User, Course.teacher_id == User.id) \
+            .filter(Course.id == id, *live(Course)).first_or_404()
+        students = db.session.query(Student.id, Student.name).join(student_course) \
+            .filter(student_course.c.course_id == id, *live(Student)).all()
+        scores = db.session.query(Grade.score).filter(Grade.course_id == id, *live(Grade))
+        cache_tags(f'course:{id}', *(f'student:{student.id}' for student in students))
         return {
                    'name': course.name,
-                   'teacher': course.teacher.username,
-                   'students': [student.name for student in course.students],
-                   'grades': [grade.score for grade in course.grades]
+                   'teacher': course.username,
+                   'students': [student.name for student in students],
+                   'grades': [score for score, in scores]
                }, 200
 
     @api.expect(course_model)
@@ -309,14 +1407,9 @@ class Course(Resource):
         if not name or not teacher_id:
             return {'message': 'Missing name or teacher_id'}, 400
 
-        course = Course.query.get_or_404(id)
-
-        if Course.query.filter_by(name=name).first() and name != course.name:
-            return {'message': 'Course already exists'}, 400
-
-        teacher = User.query.get_or_404(teacher_id)
+        course = Course.query.filter(Course.id == id, *live(Course)).first_or_404()
 
-        if teacher.role != 'teacher':
+        if teacher_role(teacher_id) != 'teacher':
             return {'message': 'Invalid teacher_id'}, 400
 
         course.name = name
@@ -324,33 +1417,129 @@ class Course(Resource):
 
         try:
             db.session.commit()
+            cache.invalidate(f'course:{id}', 'courses')
             return {'message': 'Course updated successfully'}, 200
+        except IntegrityError:
+            db.session.rollback()
+            return {'message': 'Course already exists'}, 400
         except:
             return {'message': 'Something went wrong'}, 500
 
     @jwt_required()
     def delete(self, id):
-        course = Course.query.get_or_404(id)
+        course = Course.query.filter(Course.id == id, *live(Course)).first_or_404()
+        grades = db.session.query(Grade.student_id, Grade.score, Grade.id) \
+            .filter(Grade.course_id == id, *live(Grade)).order_by(Grade.id).all()
+        student_ids = {student_id for student_id, in db.session.query(student_course.c.student_id).join(Student)
+                       .filter(student_course.c.course_id == id, *live(Student))}
 
         try:
-            db.session.delete(course)
+            # the course's grades stop counting towards GPAs whether they are tombstoned or cascaded away
+            adjust_gpa([(student_id, -grade_points(score), -1) for student_id, score, _ in grades])
+            record_dependents((row[2] for row in grades), ((student_id, id) for student_id in student_ids))
+            if current_app.config['SOFT_DELETE']:
+                tombstone(Course, id, Grade.course_id == id)
+            else:
+                db.session.delete(course)
             db.session.commit()
+            cache.invalidate(f'course:{id}', 'courses', 'grades', 'enrollments',
+                             *(f'student:{student_id}' for student_id in student_ids | {row[0] for row in grades}))
             return {'message': 'Course deleted successfully'}, 200
         except:
             return {'message': 'Something went wrong'}, 500
 
 
+def enrollment_ids():
+    student_ids = (api.payload or {}).get('student_ids')
+    if not isinstance(student_ids, list) or not all(isinstance(student_id, int) for student_id in student_ids):
+        return None
+    return set(student_ids)
+
+
+def enrolled_ids(course_id, student_ids):
+    table = student_course
+    return {student_id for student_id, in db.session.query(table.c.student_id)
+            .filter(table.c.course_id == course_id, table.c.student_id.in_(student_ids))}
+
+
+def enroll(course_id, student_ids):
+    # INSERT ... SELECT skips unknown students and existing enrollments, so repeats are harmless
+    table = student_course
+    enrolled = select(table.c.student_id).where(table.c.course_id == course_id, table.c.student_id == Student.id)
+    added = 0
+    for chunk in chunked(student_ids, IN_CLAUSE_SIZE):
+        new = sorted(set(chunk) - enrolled_ids(course_id, chunk))
+        rows = select(Student.id, literal(course_id)).where(Student.id.in_(new), ~enrolled.exists())
+        added += db.session.execute(table.insert().from_select(['student_id', 'course_id'], rows)).rowcount
+        record_changes('enrollment', 'insert', [{'student_id': student_id, 'course_id': course_id}
+                                                for student_id in new])
+    return added
+
+
+def unenroll(course_id, student_ids):
+    table = student_course
+    removed = 0
+    for chunk in chunked(student_ids, IN_CLAUSE_SIZE):
+        enrolled = sorted(enrolled_ids(course_id, chunk))
+        stmt = table.delete().where(table.c.course_id == course_id, table.c.student_id.in_(enrolled))
+        removed += db.session.execute(stmt).rowcount
+        record_changes('enrollment', 'delete', [{'student_id': student_id, 'course_id': course_id}
+                                                for student_id in enrolled])
+    return removed
+
+
+@api.route('/courses/<int:id>/students')
+class CourseEnrollment(Resource):
+
+    @api.expect(enrollment_model)
+    @jwt_required()
+    def post(self, id):
+        student_ids = enrollment_ids()
+
+        if student_ids is None:
+            return {'message': 'Missing or invalid student_ids'}, 400
+
+        db.session.query(Course.id).filter(Course.id == id, *live(Course)).first_or_404()
+        missing = student_ids - existing_ids(Student.id, student_ids)
+
+        try:
+            added = enroll(id, student_ids - missing)
+            db.session.commit()
+            cache.invalidate(f'course:{id}', 'enrollments', *(f'student:{student_id}' for student_id in student_ids))
+            return {'message': 'Students enrolled successfully', 'enrolled': added, 'not_found': sorted(missing)}, 200
+        except:
+            db.session.rollback()
+            return {'message': 'Something went wrong'}, 500
+
+    @api.expect(enrollment_model)
+    @jwt_required()
+    def delete(self, id):
+        student_ids = enrollment_ids()
+
+        if student_ids is None:
+            return {'message': 'Missing or invalid student_ids'}, 400
+
+        db.session.query(Course.id).filter(Course.id == id, *live(Course)).first_or_404()
+
+        try:
+            removed = unenroll(id, student_ids)
+            db.session.commit()
+            cache.invalidate(f'course:{id}', 'enrollments', *(f'student:{student_id}' for student_id in student_ids))
+            return {'message': 'Students unenrolled successfully', 'unenrolled': removed}, 200
+        except:
+            db.session.rollback()
+            return {'message': 'Something went wrong'}, 500
+
+
 @api.route('/grades')
 class Grades(Resource):
 
     @jwt_required()
+    @cached('grade', 'student', 'course')
     def get(self):
-        grades = Grade.query.all()
-        return [{
-            'student': grade.student.name,
-            'course': grade.course.name,
-            'score': grade.score
-        } for grade in grades], 200
+        cache_tags('grades', 'students', 'courses')
+        query = filter_grades(grade_rows(), grade_filters(request.args))
+        return paginate(query, GRADE_FIELDS, GRADE_SORTS, ['student', 'course', 'score'])
 
     @api.expect(grade_model)
     @jwt_required()
@@ -363,11 +1552,8 @@ class Grades(Resource):
         if not student_id or not course_id or not score:
             return {'message': 'Missing student_id, course_id or score'}, 400
 
-        if Grade.query.filter_by(student_id=student_id, course_id=course_id).first():
-            return {'message': 'Grade already exists'}, 400
-
-        student = Student.query.get_or_404(student_id)
-        course = Course.query.get_or_404(course_id)
+        student = Student.query.filter(Student.id == student_id, *live(Student)).first_or_404()
+        course = Course.query.filter(Course.id == course_id, *live(Course)).first_or_404()
 
         if score < 0 or score > 100:
             return {'message': 'Invalid score'}, 400
@@ -375,24 +1561,579 @@ class Grades(Resource):
         grade = Grade(student_id=student_id, course_id=course_id, score=score)
 
         try:
+            if current_app.config['SOFT_DELETE']:
+                release_grade_keys([(student_id, course_id)])
             db.session.add(grade)
+            adjust_gpa([(student_id, grade_points(score), 1)])
             db.session.commit()
+            cache.invalidate('grades', f'student:{student_id}', f'course:{course_id}')
             return {'message': 'Grade created successfully'}, 201
+        except IntegrityError:
+            db.session.rollback()
+            return {'message': 'Grade already exists'}, 400
         except:
             return {'message': 'Something went wrong'}, 500
 
 
+# bulk ingestion: rows are validated with set-based lookups and inserted with executemany
+BULK_BATCH_SIZE = 1000
+IN_CLAUSE_SIZE = 500  # stays under SQLite's bound-parameter limit
+
+
+def chunked(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def existing_ids(column, ids):
+    found = set()
+    for chunk in chunked(ids, IN_CLAUSE_SIZE):
+        found.update(value for value, in db.session.query(column).filter(column.in_(chunk), *live(column.class_)))
+    return found
+
+
+def existing_grades(pairs):
+    course_ids = {course_id for _, course_id in pairs}
+    found = set()
+    for chunk in chunked({student_id for student_id, _ in pairs}, IN_CLAUSE_SIZE):
+        found.update(db.session.query(Grade.student_id, Grade.course_id)
+                     .filter(Grade.student_id.in_(chunk), Grade.course_id.in_(course_ids), *live(Grade)))
+    return found & pairs
+
+
+def created_grades(records):
+    # executemany doesn't hand back the new ids, so read them in the inserting transaction for the change feed
+    pairs = {(record['student_id'], record['course_id']) for record in records}
+    course_ids = {course_id for _, course_id in pairs}
+    rows = []
+    for chunk in chunked({student_id for student_id, _ in pairs}, IN_CLAUSE_SIZE):
+        query = db.session.query(Grade.id, Grade.student_id, Grade.course_id, Grade.score) \
+            .filter(Grade.student_id.in_(chunk), Grade.course_id.in_(course_ids), *live(Grade))
+        rows.extend(dict(zip(CHANGE_FIELDS['grade'], row)) for row in query if (row[1], row[2]) in pairs)
+    return sorted(rows, key=lambda row: row['id'])
+
+
+def validate_grades(rows):
+    # the insertable records, the GPA change per student they make, and an error for every other row
+    errors = []
+    parsed = []
+    seen = set()
+    for index, row in enumerate(rows):
+        values = parse_grade_row(row) if isinstance(row, dict) else None
+        if values is None:
+            errors.append({'row': index, 'message': 'Missing or invalid student_id, course_id or score'})
+            continue
+        student_id, course_id, score = values
+        if not 0 <= score <= 100:
+            errors.append({'row': index, 'message': 'Invalid score'})
+            continue
+        if (student_id, course_id) in seen:
+            errors.append({'row': index, 'message': 'Duplicate grade in upload'})
+            continue
+        seen.add((student_id, course_id))
+        parsed.append((index, student_id, course_id, score))
+
+    students = existing_ids(Student.id, {row[1] for row in parsed})
+    courses = existing_ids(Course.id, {row[2] for row in parsed})
+    duplicates = existing_grades(seen)
+
+    records = []
+    gpa_changes = {}
+    for index, student_id, course_id, score in parsed:
+        if student_id not in students:
+            errors.append({'row': index, 'message': 'Student not found'})
+        elif course_id not in courses:
+            errors.append({'row': index, 'message': 'Course not found'})
+        elif (student_id, course_id) in duplicates:
+            errors.append({'row': index, 'message': 'Grade already exists'})
+        else:
+            records.append({'student_id': student_id, 'course_id': course_id, 'score': score})
+            totals = gpa_changes.setdefault(student_id, [0.0, 0])
+            totals[0] += grade_points(score)
+            totals[1] += 1
+
+    errors.sort(key=lambda error: error['row'])
+    return records, gpa_changes, errors
+
+
+def insert_grades(records, gpa_changes, progress=None):
+    # one transaction however many batches, so a failed upload leaves nothing behind
+    done = 0
+    if current_app.config['SOFT_DELETE']:
+        release_grade_keys((record['student_id'], record['course_id']) for record in records)
+    for batch in chunked(records, BULK_BATCH_SIZE):
+        db.session.execute(Grade.__table__.insert(), batch)
+        done += len(batch)
+        if progress is not None:
+            progress(done)
+    record_changes('grade', 'insert', created_grades(records))
+    adjust_gpa((student_id, points, credits) for student_id, (points, credits) in gpa_changes.items())
+    db.session.commit()
+    cache.invalidate('grades', *(f'student:{student_id}' for student_id in gpa_changes),
+                     *{f'course:{record["course_id"]}' for record in records})
+
+
+def read_bulk_rows():
+    upload = request.files.get('file')
+    if upload:
+        return list(csv.DictReader(io.TextIOWrapper(upload.stream, encoding='utf-8')))
+    if request.mimetype == 'text/csv':
+        return list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    return request.get_json(silent=True)
+
+
+def parse_score(value):
+    # float() also takes 'nan', which no range check catches, and 'inf'
+    score = float(value)
+    if not math.isfinite(score):
+        raise ValueError(value)
+    return score
+
+
+def parse_grade_row(row):
+    try:
+        return int(row['student_id']), int(row['course_id']), parse_score(row['score'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def parse_score_update(row):
+    # a grade is addressed by id, or by student_id and course_id
+    try:
+        if row.get('id') not in (None, ''):
+            return int(row['id']), parse_score(row['score'])
+        return (int(row['student_id']), int(row['course_id'])), parse_score(row['score'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def current_grades(ids, pairs):
+    # maps each requested id or (student_id, course_id) to (id, (student_id, course_id, score))
+    columns = (Grade.id, Grade.student_id, Grade.course_id, Grade.score)
+    found = {}
+    for chunk in chunked(ids, IN_CLAUSE_SIZE):
+        query = db.session.query(*columns).filter(Grade.id.in_(chunk), *live(Grade))
+        for id, student_id, course_id, score in query:
+            found[id] = id, (student_id, course_id, score)
+    course_ids = {course_id for _, course_id in pairs}
+    for chunk in chunked({student_id for student_id, _ in pairs}, IN_CLAUSE_SIZE):
+        query = db.session.query(*columns).filter(Grade.student_id.in_(chunk), Grade.course_id.in_(course_ids),
+                                                  *live(Grade))
+        for id, student_id, course_id, score in query:
+            if (student_id, course_id) in pairs:
+                found[student_id, course_id] = id, (student_id, course_id, score)
+    return found
+
+
+class GradeChanged(Exception):
+    pass
+
+
+def exists_id(column, value):
+    return db.session.query(column).filter(column == value, *live(column.class_)).exists()
+
+
+def update_grades(connection, changes):
+    # changes: (id, (student_id, course_id, score) as read, (student_id, course_id, score) to write);
+    # the WHERE re-checks what was read, so a concurrent write raises GradeChanged instead of skewing GPAs
+    table = Grade.__table__
+    stmt = table.update().where(table.c.id == bindparam('grade'),
+                                table.c.student_id == bindparam('old_student'),
+                                table.c.course_id == bindparam('old_course'),
+                                table.c.score == bindparam('old_score')) \
+        .values(student_id=bindparam('new_student'), course_id=bindparam('new_course'), score=bindparam('new_score'))
+    params = []
+    logged = []
+    gpa_changes = {}
+    for id, (old_student, old_course, old_score), (new_student, new_course, new_score) in changes:
+        params.append({'grade': id, 'old_student': old_student, 'old_course': old_course, 'old_score': old_score,
+                       'new_student': new_student, 'new_course': new_course, 'new_score': new_score})
+        logged.append({'id': id, 'student_id': new_student, 'course_id': new_course, 'score': new_score})
+        for student_id, points, credits in ((old_student, -grade_points(old_score), -1),
+                                            (new_student, grade_points(new_score), 1)):
+            totals = gpa_changes.setdefault(student_id, [0.0, 0])
+            totals[0] += points
+            totals[1] += credits
+    # a grade moved to another student or course, which runs without the app context in group commit mode
+    release_grade_keys({(new_student, new_course) for _, old, (new_student, new_course, _) in changes
+                        if (new_student, new_course) != old[:2]}, connection)
+    if connection.execute(stmt, params).rowcount != len(params):
+        raise GradeChanged()
+    record_changes('grade', 'update', logged, connection)
+    adjust_gpa(((student_id, points, credits) for student_id, (points, credits) in gpa_changes.items()
+                if points or credits), connection)
+
+
+@api.route('/grades/bulk')
+class GradesBulk(Resource):
+
+    @jwt_required()
+    def post(self):
+        rows = read_bulk_rows()
+
+        if not isinstance(rows, list) or not rows:
+            return {'message': 'Expected a JSON array or CSV upload of grades'}, 400
+
+        records, gpa_changes, errors = validate_grades(rows)
+
+        if not records:
+            return {'message': 'No grades created', 'created': 0, 'errors': errors}, 400
+
+        try:
+            insert_grades(records, gpa_changes)
+            return {'message': 'Grades created successfully', 'created': len(records), 'errors': errors}, 201
+        except IntegrityError:
+            db.session.rollback()
+            return {'message': 'Grades changed during upload, retry'}, 409
+        except:
+            db.session.rollback()
+            return {'message': 'Something went wrong'}, 500
+
+    @jwt_required()
+    def patch(self):
+        rows = read_bulk_rows()
+
+        if not isinstance(rows, list) or not rows:
+            return {'message': 'Expected a JSON array or CSV upload of score updates'}, 400
+
+        errors = []
+        parsed = []
+        for index, row in enumerate(rows):
+            values = parse_score_update(row) if isinstance(row, dict) else None
+            if values is None:
+                errors.append({'row': index, 'message': 'Missing or invalid id, student_id, course_id or score'})
+                continue
+            key, score = values
+            if not 0 <= score <= 100:
+                errors.append({'row': index, 'message': 'Invalid score'})
+                continue
+            parsed.append((index, key, score))
+
+        current = current_grades({key for _, key, _ in parsed if not isinstance(key, tuple)},
+                                 {key for _, key, _ in parsed if isinstance(key, tuple)})
+
+        changes = []
+        seen = set()
+        for index, key, score in parsed:
+            grade = current.get(key)
+            if grade is None:
+                errors.append({'row': index, 'message': 'Grade not found'})
+            elif grade[0] in seen:
+                errors.append({'row': index, 'message': 'Duplicate grade in upload'})
+            else:
+                seen.add(grade[0])
+                id, (student_id, course_id, old_score) = grade
+                changes.append((id, (student_id, course_id, old_score), (student_id, course_id, score)))
+
+        errors.sort(key=lambda error: error['row'])
+
+        if not changes:
+            return {'message': 'No grades updated', 'updated': 0, 'errors': errors}, 400
+
+        try:
+            run_write(update_grades, changes)
+            cache.invalidate('grades', *(f'grade:{id}' for id, _, _ in changes),
+                             *{f'student:{before[0]}' for _, before, _ in changes},
+                             *{f'course:{before[1]}' for _, before, _ in changes})
+            return {'message': 'Grades updated successfully', 'updated': len(changes), 'errors': errors}, 200
+        except GradeChanged:
+            db.session.rollback()
+            return {'message': 'Grades changed during update, retry'}, 409
+        except:
+            db.session.rollback()
+            return {'message': 'Something went wrong'}, 500
+
+
+# analytics: scores are read straight into NumPy arrays, never as ORM objects
+ANALYTICS_BATCH_SIZE = 50000
+PERCENTILES = (10, 25, 50, 75, 90)
+DEFAULT_TOP_N = 10
+
+
+def load_scores(*criteria):
+    import numpy as np  # only analytics needs it, kept out of worker startup
+    # fetch from the DBAPI cursor directly, skipping per-row Row construction
+    result = db.session.connection().execute(select(Grade.score).where(*criteria, *live(Grade)))
+    batches = []
+    try:
+        while True:
+            rows = result.cursor.fetchmany(ANALYTICS_BATCH_SIZE)
+            if not rows:
+                break
+            batches.append(np.fromiter(chain.from_iterable(rows), dtype=np.float64, count=len(rows)))
+    finally:
+        result.close()
+    return np.concatenate(batches) if batches else np.empty(0)
+
+
+def letter_histogram(scores):
+    import numpy as np
+    # np.digitize buckets scores by the ascending cutoffs of GRADE_SCALE, bucket 0 is failing
+    cutoffs = [cutoff for cutoff, _, _ in reversed(GRADE_SCALE)]
+    letters = [FAILING_LETTER] + [letter for _, _, letter in reversed(GRADE_SCALE)]
+    counts = np.bincount(np.digitize(scores, cutoffs), minlength=len(letters))
+    return {letter: int(count) for letter, count in zip(letters, counts)}
+
+
+def score_summary(scores):
+    import numpy as np
+    if not scores.size:
+        return {'count': 0, 'mean': None, 'median': None, 'stddev': None,
+                'percentiles': {}, 'letters': letter_histogram(scores)}
+    values = np.percentile(scores, PERCENTILES)
+    return {
+        'count': int(scores.size),
+        'mean': round(float(scores.mean()), 2),
+        'median': round(float(np.median(scores)), 2),
+        'stddev': round(float(scores.std()), 2),
+        'percentiles': {f'p{p}': round(float(value), 2) for p, value in zip(PERCENTILES, values)},
+        'letters': letter_histogram(scores)
+    }
+
+
+def gpa_ranking(limit, course_ids=None):
+    query = db.session.query(Student.id, Student.name, Student.gpa).filter(Student.gpa.isnot(None), *live(Student))
+    if course_ids:
+        query = query.filter(Student.id.in_(select(Grade.student_id).where(Grade.course_id.in_(course_ids))))
+    rows = query.order_by(Student.gpa.desc(), Student.id).limit(limit)
+    return [{'id': row.id, 'name': row.name, 'gpa': row.gpa} for row in rows]
+
+
+def top_n():
+    return max(1, min(request.args.get('top', DEFAULT_TOP_N, type=int), MAX_PAGE_SIZE))
+
+
+@api.route('/analytics/courses/<int:id>')
+class CourseAnalytics(Resource):
+
+    @jwt_required()
+    def get(self, id):
+        course = db.session.query(Course.id, Course.name).filter(Course.id == id, *live(Course)).first_or_404()
+        summary = score_summary(load_scores(Grade.course_id == id))
+        summary.update({'course': course.name, 'top': gpa_ranking(top_n(), [id])})
+        return summary, 200
+
+
+@api.route('/analytics/cohort')
+class CohortAnalytics(Resource):
+
+    @jwt_required()
+    def get(self):
+        course_ids = request.args.getlist('course_id', type=int)
+        criteria = [Grade.course_id.in_(course_ids)] if course_ids else []
+        summary = score_summary(load_scores(*criteria))
+        summary['top'] = gpa_ranking(top_n(), course_ids)
+        return summary, 200
+
+
+# transcripts: graded courses per student, built from one grade query per batch of students
+TRANSCRIPT_BATCH_SIZE = 1000
+TRANSCRIPT_CSV_HEADER = ('student_id', 'name', 'email', 'gpa', 'credits', 'course_id', 'course', 'score', 'letter',
+                         'points')
+CSV_CHUNK_SIZE = 64 * 1024
+
+
+def transcript_students():
+    return db.session.query(Student).with_entities(Student.id, Student.name, Student.email, Student.gpa,
+                                                   Student.total_credits).filter(*live(Student))
+
+
+def transcripts_query(course_ids):
+    # every student, or those graded in any of course_ids
+    query = transcript_students()
+    if course_ids:
+        query = query.filter(Student.id.in_(select(Grade.student_id).where(Grade.course_id.in_(course_ids))))
+    return query
+
+
+def transcript_courses(first_id, last_id):
+    # a range on student_id rides ix_grade_student_course, rows come back grouped by student
+    query = db.session.query(Grade.student_id, Grade.course_id, Course.name, Grade.score) \
+        .join(Course, Grade.course_id == Course.id) \
+        .filter(Grade.student_id.between(first_id, last_id), *live(Grade)) \
+        .order_by(Grade.student_id, Course.name)
+    courses = {}
+    for student_id, course_id, name, score in fetch_rows(query):
+        courses.setdefault(student_id, []).append({
+            'course_id': course_id,
+            'course': name,
+            'score': score,
+            'letter': grade_letter(score),
+            'points': grade_points(score)
+        })
+    return courses
+
+
+def transcript(student, courses):
+    student_id, name, email, gpa, credits = student
+    return {'id': student_id, 'name': name, 'email': email, 'gpa': gpa, 'credits': credits, 'courses': courses}
+
+
+def iter_transcripts(query):
+    # two queries per TRANSCRIPT_BATCH_SIZE students, so memory stays flat for a whole cohort
+    after = None
+    while True:
+        students = keyset_page(query.order_by(Student.id), (Student.id,), False, after, TRANSCRIPT_BATCH_SIZE)
+        if not students:
+            return
+        courses = transcript_courses(students[0][0], students[-1][0])
+        for student in students:
+            yield transcript(student, courses.get(student[0], []))
+        after = students[-1][:1]
+
+
+def transcripts_csv(transcripts):
+    # one line per graded course, students without grades get a single line with the course columns empty
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(TRANSCRIPT_CSV_HEADER)
+    for entry in transcripts:
+        student = [entry['id'], entry['name'], entry['email'], entry['gpa'], entry['credits']]
+        for course in entry['courses'] or [None]:
+            if course is None:
+                writer.writerow(student)
+            else:
+                writer.writerow(student + [course['course_id'], course['course'], course['score'], course['letter'],
+                                           course['points']])
+        if buffer.tell() >= CSV_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+@api.route('/students/<int:id>/transcript')
+class StudentTranscript(Resource):
+
+    @jwt_required()
+    @cached('student', 'grade', 'course')
+    def get(self, id):
+        student = transcript_students().filter(Student.id == id).first_or_404()
+        courses = transcript_courses(id, id).get(id, [])
+        cache_tags(f'student:{id}', *(f'course:{course["course_id"]}' for course in courses))
+        return transcript(student, courses), 200
+
+
+@api.route('/transcripts')
+class Transcripts(Resource):
+
+    @jwt_required()
+    def get(self):
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in ('ndjson', 'csv'):
+            return {'message': 'Invalid format, expected ndjson or csv'}, 400
+
+        transcripts = iter_transcripts(transcripts_query(request.args.getlist('course_id', type=int)))
+
+        if fmt == 'csv':
+            return Response(stream_with_context(transcripts_csv(transcripts)), mimetype='text/csv',
+                            headers={'Content-Disposition': 'attachment; filename=transcripts.csv'})
+        return Response(stream_with_context(dumps(entry) + b'\n' for entry in transcripts),
+                        mimetype='application/x-ndjson')
+
+
+# search: every word of q must start a word of the name or email. Each kind reads at most SEARCH_CANDIDATES
+# matches, in id order, so a broad prefix can't turn into a scan of the whole index, and those are ordered by
+# search_rank(). When a kind has more, X-Search-Truncated says the hits are the best of the matches read, not
+# of all of them; a longer q reaches the rest
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+SEARCH_CANDIDATES = 1000
+MIN_TERM_LENGTH = 2  # single letters match most of the index and only slow the query down
+
+
+def search_terms():
+    return [term for term in tokenize(request.args.get('q', '')) if len(term) >= MIN_TERM_LENGTH]
+
+
+def fts5_candidates(terms, kind):
+    # no bm25(): its IDF step reads the full doclist of every term, tens of ms for a common prefix. Reads one
+    # match over SEARCH_CANDIDATES, to tell whether there are more
+    match = ' '.join(f'"{term}"*' for term in terms)
+    email = f'{kind}_fts.email' if kind == 'student' else 'NULL'
+    sql = f'SELECT {kind}_fts.rowid, {kind}_fts.name, {email} FROM {kind}_fts'
+    if current_app.config['SOFT_DELETE']:
+        sql += f' JOIN {kind} ON {kind}.id = {kind}_fts.rowid AND {kind}.deleted_at IS NULL'
+    sql += f' WHERE {kind}_fts MATCH :match LIMIT :limit'
+    return db.session.execute(text(sql), {'match': match, 'limit': SEARCH_CANDIDATES + 1}).fetchall()
+
+
+def token_candidates(terms, kind):
+    # like fts5_candidates(), one match over SEARCH_CANDIDATES when there are more
+    token = search_token.c.token
+    matches = union_all(*(
+        select(search_token.c.ref_id, literal(index).label('term'))
+        .where(search_token.c.kind == kind, token >= term, token < term[:-1] + chr(ord(term[-1]) + 1))
+        for index, term in enumerate(terms)
+    )).subquery()
+    ids = select(matches.c.ref_id).group_by(matches.c.ref_id) \
+        .having(func.count(matches.c.term.distinct()) == len(terms)) \
+        .order_by(matches.c.ref_id).limit(SEARCH_CANDIDATES + 1).scalar_subquery()
+    if kind == 'student':
+        return db.session.query(Student.id, Student.name, Student.email) \
+            .filter(Student.id.in_(ids), *live(Student)).all()
+    return db.session.query(Course.id, Course.name, literal(None)).filter(Course.id.in_(ids), *live(Course)).all()
+
+
+def search_rank(terms, name):
+    # whole words of the name first, then word prefixes in the name, then shorter names
+    words = tokenize(name)
+    return (-sum(term in words for term in terms),
+            -sum(any(word.startswith(term) for word in words) for term in terms),
+            len(name))
+
+
+def serialize_hit(kind, hit):
+    if kind == 'course':
+        return {'type': kind, 'id': hit[0], 'name': hit[1]}
+    return {'type': kind, 'id': hit[0], 'name': hit[1], 'email': hit[2]}
+
+
+@api.route('/search')
+class Search(Resource):
+
+    @jwt_required()
+    @cached('student', 'course')
+    def get(self):
+        terms = search_terms()
+        if not terms:
+            return {'message': f'Missing q, search words need at least {MIN_TERM_LENGTH} characters'}, 400
+
+        kind = request.args.get('type')
+        if kind is not None and kind not in SEARCH_COLUMNS:
+            return {'message': 'Invalid type, expected student or course'}, 400
+        kinds = [kind] if kind else list(SEARCH_COLUMNS)
+
+        limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), MAX_SEARCH_PAGE_SIZE))
+        offset = max(0, request.args.get('offset', 0, type=int))
+
+        cache_tags('students', 'courses')
+        candidates = fts5_candidates if search_backend(db.engine.dialect) == 'fts5' else token_candidates
+        hits, truncated = [], False
+        for kind in kinds:
+            rows = candidates(terms, kind)
+            truncated = truncated or len(rows) > SEARCH_CANDIDATES
+            hits += [(search_rank(terms, hit[1]), kind, hit[0], hit) for hit in rows[:SEARCH_CANDIDATES]]
+        hits.sort()
+        page = hits[offset:offset + limit]
+        headers = {}
+        if len(hits) > offset + limit:
+            headers['X-Next-Offset'] = str(offset + limit)
+        if truncated:
+            headers['X-Search-Truncated'] = 'true'
+        return [serialize_hit(kind, hit) for _, kind, _, hit in page], 200, headers
+
+
 @api.route('/grades/<int:id>')
-class Grade(Resource):
+class GradeDetail(Resource):
 
     @jwt_required()
+    @cached('grade', 'student', 'course')
     def get(self, id):
-        grade = Grade.query.get_or_404(id)
-        return {
-                   'student': grade.student.name,
-                   'course': grade.course.name,
-                   'score': grade.score
-               }, 200
+        grade = grade_rows().filter(Grade.id == id).first_or_404()
+        cache_tags(f'grade:{id}', f'student:{grade.student_id}', f'course:{grade.course_id}')
+        return serialize_grade(grade), 200
 
     @api.expect(grade_model)
     @jwt_required()
@@ -405,30 +2146,322 @@ class Grade(Resource):
         if not student_id or not course_id or not score:
             return {'message': 'Missing student_id, course_id or score'}, 400
 
-        grade = Grade.query.get_or_404(id)
-
-        student = Student.query.get_or_404(student_id)
-        course = Course.query.get_or_404(course_id)
+        # the grade and both existence checks in one round trip
+        grade = db.session.query(Grade.student_id, Grade.course_id, Grade.score,
+                                 exists_id(Student.id, student_id), exists_id(Course.id, course_id)) \
+            .filter(Grade.id == id, *live(Grade)).first()
+        if grade is None or not all(grade[3:]):
+            abort(404)
 
         if score < 0 or score > 100:
             return {'message': 'Invalid score'}, 400
 
-        grade.student_id = student_id
-        grade.course_id = course_id
-        grade.score = score
+        stale = [f'grade:{id}', 'grades', f'student:{grade.student_id}', f'course:{grade.course_id}',
+                 f'student:{student_id}', f'course:{course_id}']
 
         try:
-            db.session.commit()
+            run_write(update_grades, [(id, tuple(grade[:3]), (student_id, course_id, score))])
+            cache.invalidate(*stale)
             return {'message': 'Grade updated successfully'}, 200
+        except GradeChanged:
+            db.session.rollback()
+            return {'message': 'Grade changed during update, retry'}, 409
+        except IntegrityError:
+            db.session.rollback()
+            return {'message': 'Grade already exists'}, 400
         except:
+            db.session.rollback()
             return {'message': 'Something went wrong'}, 500
 
     @jwt_required()
     def delete(self, id):
-        grade = Grade.query.get_or_404(id)
+        grade = Grade.query.filter(Grade.id == id, *live(Grade)).first_or_404()
+        student_id, course_id, score = grade.student_id, grade.course_id, grade.score
         try:
-            db.session.delete(grade)
+            if current_app.config['SOFT_DELETE']:
+                tombstone(Grade, id)
+            else:
+                db.session.delete(grade)
+            adjust_gpa([(student_id, -grade_points(score), -1)])
             db.session.commit()
+            cache.invalidate(f'grade:{id}', 'grades', f'student:{student_id}', f'course:{course_id}')
             return {'message': 'Grade deleted successfully'}, 200
         except:
             return {'message': 'Something went wrong'}, 500
+
+
+def serialize_change(row):
+    seq, entity, op, data = row
+    return {'seq': seq, 'entity': entity, 'op': op, 'data': loads(data)}
+
+
+@api.route('/changes')
+class Changes(Resource):
+
+    @jwt_required()
+    def get(self):
+        # every change after ?since=<seq>, oldest first; resume from X-Next-Since, or take them all with ?stream=
+        since = request.args.get('since', 0, type=int)
+        fmt = request.args.get('stream')
+        query = db.session.query(change_log.c.seq, change_log.c.entity, change_log.c.op, change_log.c.data) \
+            .order_by(change_log.c.seq)
+        delay = current_app.config['CHANGE_FEED_DELAY']
+        if delay:
+            query = query.filter(change_log.c.changed_at <= datetime.utcnow() - timedelta(seconds=delay))
+        keys = (change_log.c.seq,)
+
+        if fmt:
+            if fmt not in ('ndjson', 'json'):
+                return {'message': 'Invalid stream format'}, 400
+            return stream_listing(iter_keyset(query, keys, False, (since,)), serialize_change, fmt)
+
+        rows = keyset_page(query, keys, False, (since,), page_args())
+        return [serialize_change(row) for row in rows], 200, {'X-Next-Since': str(rows[-1][0] if rows else since)}
+
+
+# background jobs: exports, imports and the GPA rebuild run in `flask run-jobs` pool processes instead of
+# holding a request worker; their cache invalidations reach the web workers with CACHE_BACKEND=sqlite only,
+# local caches catch up within CACHE_TTL
+JOB_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+GRADE_EXPORT_FIELDS = ('id', 'student_id', 'student', 'course_id', 'course', 'score')
+
+
+class JobFailed(Exception):
+    pass
+
+
+class Reporting:
+    # passes items through, reporting the count so far every `every` items and once at the end
+
+    def __init__(self, items, progress, every=STREAM_BATCH_SIZE):
+        self.items = items
+        self.progress = progress
+        self.every = every
+        self.count = 0
+
+    def __iter__(self):
+        for self.count, item in enumerate(self.items, 1):
+            yield item
+            if self.count % self.every == 0:
+                self.progress(self.count)
+        self.progress(self.count)
+
+
+def export_grades(job, progress):
+    params = job['params']
+    query = filter_grades(grade_rows(), params)
+    progress(0, query.count())
+    query = query.with_entities(Grade.id, *(GRADE_FIELDS[name] for name in GRADE_EXPORT_FIELDS))
+    rows = Reporting(iter_keyset(query, (Grade.id,), False, None), progress)
+    filename = f'grades.{params["format"]}'
+    with jobs.open_output(job['id'], filename) as out:
+        if params['format'] == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(GRADE_EXPORT_FIELDS)
+            writer.writerows(row[1:] for row in rows)
+        else:
+            out.writelines(dumps(dict(zip(GRADE_EXPORT_FIELDS, row[1:]))).decode() + '\n' for row in rows)
+    return {'rows': rows.count}, filename
+
+
+def export_transcripts(job, progress):
+    params = job['params']
+    query = transcripts_query(params['course_id'])
+    progress(0, query.count())
+    transcripts = Reporting(iter_transcripts(query), progress, TRANSCRIPT_BATCH_SIZE)
+    if params['format'] == 'csv':
+        chunks = transcripts_csv(transcripts)
+    else:
+        chunks = (dumps(entry).decode() + '\n' for entry in transcripts)
+    filename = f'transcripts.{params["format"]}'
+    with jobs.open_output(job['id'], filename) as out:
+        out.writelines(chunks)
+    return {'students': transcripts.count}, filename
+
+
+def read_bulk_file(path):
+    # the upload a grades_import job was queued with, in the formats /grades/bulk takes
+    try:
+        if path.endswith('.csv'):
+            with open(path, encoding='utf-8', newline='') as file:
+                return list(csv.DictReader(file))
+        with open(path, 'rb') as file:
+            return loads(file.read())
+    except ValueError:
+        return None
+
+
+def import_grades(job, progress):
+    rows = read_bulk_file(os.path.join(jobs.job_dir(job['id']), job['params']['input']))
+    if not isinstance(rows, list) or not rows:
+        raise JobFailed('Expected a JSON array or CSV upload of grades')
+    records, gpa_changes, errors = validate_grades(rows)
+    progress(0, len(records))
+    try:
+        insert_grades(records, gpa_changes, progress)
+    except IntegrityError:
+        raise JobFailed('Grades changed during upload, retry')
+    return {'created': len(records), 'errors': errors}, None
+
+
+def rebuild_gpa_job(job, progress):
+    progress(0, 1)
+    recompute_gpa()
+    db.session.commit()
+    cache.clear()  # every student's GPA may have moved
+    progress(1)
+    return {}, None
+
+
+def export_params():
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in JOB_FORMATS:
+        api.abort(400, 'Invalid format, expected ndjson or csv')
+    return {'format': fmt}
+
+
+def grades_export_params():
+    return dict(export_params(), **grade_filters(request.args)), None
+
+
+def transcripts_export_params():
+    return dict(export_params(), course_id=request.args.getlist('course_id', type=int)), None
+
+
+def grades_import_params():
+    # the upload is saved as it arrives, parsing and validation wait for the worker
+    upload = request.files.get('file')
+    if upload:
+        return {'input': 'grades.csv'}, {'grades.csv': upload.stream}
+    if request.mimetype == 'text/csv':
+        return {'input': 'grades.csv'}, {'grades.csv': request.stream}
+    if request.mimetype == 'application/json':
+        return {'input': 'grades.json'}, {'grades.json': request.stream}
+    api.abort(400, 'Expected a JSON array or CSV upload of grades')
+
+
+def no_params():
+    return {}, None
+
+
+# name -> (reads the job's params and input files from the request, runs the job in a pool process and
+# returns (result, name of the result file or None))
+JOB_TYPES = {
+    'grades_export': (grades_export_params, export_grades),
+    'transcripts_export': (transcripts_export_params, export_transcripts),
+    'grades_import': (grades_import_params, import_grades),
+    'gpa_rebuild': (no_params, rebuild_gpa_job),
+}
+
+
+def init_job_process(app):
+    app.app_context().push()
+    db.engine.dispose(close=False)  # pooled connections are never shared with the parent
+
+
+def run_job(job):
+    # in a pool process, see JobQueue.work()
+    try:
+        result, file = JOB_TYPES[job['type']][1](job, partial(jobs.progress, job))
+        jobs.finish(job, result, file)
+    except JobLost:
+        db.session.rollback()  # requeued meanwhile, the job's new attempt records the outcome
+    except JobFailed as error:
+        db.session.rollback()
+        jobs.fail(job, str(error))
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception('Job %s failed', job['id'])
+        jobs.fail(job, 'Something went wrong')
+    finally:
+        db.session.remove()
+
+
+@server.cli.command('run-jobs')
+@click.option('--workers', type=int, help='Pool processes, defaults to JOB_WORKERS.')
+def run_jobs(workers):
+    """Run queued background jobs on a process pool until interrupted."""
+    config = current_app.config
+    workers = workers or config['JOB_WORKERS']
+    click.echo(f'Running jobs on {workers} processes')
+    jobs.work(run_job, workers, config['JOB_POLL_INTERVAL'], config['JOB_RETENTION_HOURS'] * 3600,
+              init_job_process, (current_app._get_current_object(),))
+
+
+def timestamp(value):
+    return datetime.utcfromtimestamp(value).isoformat() + 'Z' if value is not None else None
+
+
+def serialize_job(job):
+    return {
+        'id': job['id'],
+        'type': job['type'],
+        'status': job['status'],
+        'progress': {'done': job['done'], 'total': job['total']},
+        'result': job['result'],
+        'error': job['error'],
+        'created_at': timestamp(job['created_at']),
+        'started_at': timestamp(job['started_at']),
+        'finished_at': timestamp(job['finished_at']),
+        'download': api.url_for(JobResult, id=job['id']) if job['file'] else None
+    }
+
+
+@api.route('/jobs/<string:name>')
+class JobSubmit(Resource):
+
+    @jwt_required()
+    def post(self, name):
+        if name not in JOB_TYPES:
+            return {'message': f'Unknown job type, expected one of: {", ".join(JOB_TYPES)}'}, 404
+        params, inputs = JOB_TYPES[name][0]()
+        try:
+            id = jobs.enqueue(name, params, str(get_jwt_identity()), inputs)
+        except:
+            return {'message': 'Something went wrong'}, 500
+        return {'message': 'Job queued', 'id': id}, 202, {'Location': api.url_for(JobStatus, id=id)}
+
+
+def owned_job(id):
+    # another user's job answers like a missing one, so job ids can't be probed
+    job = jobs.get(id)
+    if job is None or job['created_by'] != str(get_jwt_identity()):
+        abort(404)
+    return job
+
+
+@api.route('/jobs/<int:id>')
+class JobStatus(Resource):
+
+    @jwt_required()
+    def get(self, id):
+        return serialize_job(owned_job(id)), 200
+
+
+@api.route('/jobs/<int:id>/result')
+class JobResult(Resource):
+
+    @jwt_required()
+    def get(self, id):
+        job = owned_job(id)
+        if job['status'] != 'done':
+            return {'message': f'Job is {job["status"]}'}, 409
+        if job['file'] is None:
+            return {'message': 'Job has no result file'}, 404
+        return send_file(os.path.join(jobs.job_dir(id), job['file']), as_attachment=True,
+                         mimetype=JOB_FORMATS[job['file'].rsplit('.', 1)[1]])
+
+
+def create_app(config=None, instance_path=None):
+    """Build the Flask app. Once per process: it also replaces the services above, wsgi.py holds the instance."""
+    app = Flask(__name__, instance_path=instance_path)
+    configure(app)
+    app.config.update(config or {})
+
+    db.init_app(app)
+    jwt.init_app(app)
+    api.init_app(app, add_specs=app.config['API_DOCS'])
+    init_services(app)
+    app.register_blueprint(server)
+    app.add_url_rule('/metrics', 'prometheus_metrics', prometheus_metrics)
+    return app
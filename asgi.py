@@ -0,0 +1,346 @@
+"""ASGI entry point for high-concurrency read traffic.
+
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker -w 4
+
+GET requests for the student, course and grade listings and detail views
+are answered by coroutines on SQLAlchemy's async engine (aiosqlite or
+aiomysql), so one worker keeps many requests in flight while they wait on
+the database. Every other request is handed to the Flask app unchanged.
+Conditional GETs and response compression follow the Flask app's rules.
+"""
+import hashlib
+import math
+import re
+import time
+from urllib.parse import parse_qsl
+
+import jwt as pyjwt
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.exceptions import NotFound
+from werkzeug.http import parse_accept_header, parse_date, parse_etags
+
+from app import (Course, Grade, Student, User, student_course, db, metrics, not_modified, rate_limit_wait,
+                 serialize_grade, validator_headers, validators, versions_select, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE,
+                 RATE_LIMITED, STREAM_BATCH_SIZE)
+from cache import LocalCache
+from compression import COMPRESSIBLE, compress, compressor, negotiate
+from serialization import dumps
+from wsgi import app as flask_app
+
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'mysql': 'mysql+aiomysql'}
+# filtered, sorted or projected listings (?course_id=, ?sort=, ?fields=, ...) are left to the Flask app
+ASYNC_ARGS = {'limit', 'after', 'stream'}
+
+
+def async_engine():
+    with flask_app.app_context():
+        url = db.engine.url
+    options = dict(flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    if url.get_backend_name() == 'sqlite':
+        # aiosqlite defaults to NullPool for file databases, which starts a new connection thread per request
+        options.update(poolclass=AsyncAdaptedQueuePool, connect_args={'timeout': 5})
+    return create_async_engine(url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()]), **options)
+
+
+engine = async_engine()
+SOFT_DELETE = flask_app.config['SOFT_DELETE']
+verified_tokens = LocalCache(max_entries=flask_app.config['JWT_VERIFIED_CACHE_SIZE'])
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, body, headers=()):
+        super().__init__(status)
+        self.status = status
+        self.body = body
+        self.headers = headers
+
+
+def not_found():
+    return HTTPError(404, {'message': NotFound.description})
+
+
+def authenticate(headers):
+    # same checks as @jwt_required(), with the same verified-token cache as CachingJWTManager
+    authorization = headers.get(b'authorization', b'').decode()
+    if not authorization.startswith('Bearer '):
+        raise HTTPError(401, {'msg': 'Missing Authorization Header'})
+    token = authorization[len('Bearer '):]
+    key = hashlib.sha256(token.encode()).digest()
+    claims = verified_tokens.get(key)
+    if claims is None:
+        config = flask_app.config
+        try:
+            claims = pyjwt.decode(token, config['JWT_SECRET_KEY'], algorithms=[config.get('JWT_ALGORITHM', 'HS256')])
+        except pyjwt.ExpiredSignatureError:
+            raise HTTPError(401, {'msg': 'Token has expired'})
+        except pyjwt.InvalidTokenError as error:
+            raise HTTPError(422, {'msg': str(error)})
+        if claims.get('type') != 'access':
+            raise HTTPError(422, {'msg': 'Only non-refresh tokens are allowed'})
+        if 'exp' in claims:
+            verified_tokens.set(key, claims, ttl=claims['exp'] - time.time())
+    return claims
+
+
+def int_arg(args, name, default):
+    try:
+        return int(args[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def compressing(send, encoding, extra_headers):
+    # wraps send like app.compress_response(): a 200 gets extra_headers and, for a compressible type, its body
+    # compressed. A body sent in one message is held until it arrives, to check it against COMPRESSION_MIN_SIZE
+    # and recount content-length; a streamed one is compressed message by message
+    config = flask_app.config
+    held = None
+    stream = None
+
+    async def send_body(message):
+        more_body = message.get('more_body', False)
+        data = stream.compress(message.get('body', b''))
+        if not more_body:
+            data += stream.flush()
+        if data or not more_body:
+            await send({'type': 'http.response.body', 'body': data, 'more_body': more_body})
+
+    async def send_compressed(message):
+        nonlocal held, stream
+        if stream is not None:
+            return await send_body(message)
+        if message['type'] == 'http.response.start':
+            if message['status'] == 200:
+                message = dict(message, headers=[*message['headers'], *extra_headers])
+                content_type = dict(message['headers']).get(b'content-type', b'').decode()
+                if config['COMPRESSION_ENABLED'] and content_type in COMPRESSIBLE:
+                    held = message
+                    return
+            return await send(message)
+        if held is None:
+            return await send(message)
+        start, held = held, None
+        body, more_body = message.get('body', b''), message.get('more_body', False)
+        if not more_body and len(body) < config['COMPRESSION_MIN_SIZE']:
+            await send(start)
+            return await send(message)
+        headers = [*start['headers'], (b'vary', b'Accept-Encoding')]
+        if encoding is None:
+            await send(dict(start, headers=headers))
+            return await send(message)
+        headers = [(name, value) for name, value in headers if name != b'content-length']
+        headers.append((b'content-encoding', encoding.encode()))
+        if not more_body:
+            body = compress(body, encoding, config['COMPRESSION_LEVELS'])
+            await send(dict(start, headers=[*headers, (b'content-length', str(len(body)).encode())]))
+            return await send({'type': 'http.response.body', 'body': body})
+        await send(dict(start, headers=headers))
+        stream = compressor(encoding, config['COMPRESSION_LEVELS'])
+        await send_body(message)
+
+    return send_compressed
+
+
+async def send_json(send, status, body, headers=()):
+    payload = dumps(body)
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(payload)).encode()), *headers]})
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def stream_listing(send, conn, stmt, column, serialize, fmt, after):
+    mimetype = b'application/x-ndjson' if fmt == 'ndjson' else b'application/json'
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', mimetype)]})
+    separator = b''
+    if fmt == 'json':
+        await send({'type': 'http.response.body', 'body': b'[', 'more_body': True})
+    while True:
+        rows = (await conn.execute(stmt.where(column > after).order_by(column).limit(STREAM_BATCH_SIZE))).all()
+        if not rows:
+            break
+        if fmt == 'ndjson':
+            chunk = b''.join(dumps(serialize(row)) + b'\n' for row in rows)
+        else:
+            chunk = separator + b','.join(dumps(serialize(row)) for row in rows)
+            separator = b','
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        after = rows[-1].id
+    await send({'type': 'http.response.body', 'body': b']' if fmt == 'json' else b''})
+
+
+async def paginate(send, conn, args, stmt, column, serialize):
+    # mirrors app.paginate(): keyset pages with X-Next-After, or ?stream=ndjson|json
+    limit = max(1, min(int_arg(args, 'limit', DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+    try:
+        after = int(args.get('after', 0))
+    except ValueError:
+        raise HTTPError(400, {'message': 'Invalid after cursor'})
+    fmt = args.get('stream')
+
+    if fmt:
+        if fmt not in ('ndjson', 'json'):
+            raise HTTPError(400, {'message': 'Invalid stream format'})
+        return await stream_listing(send, conn, stmt, column, serialize, fmt, after)
+
+    rows = (await conn.execute(stmt.where(column > after).order_by(column).limit(limit))).all()
+    headers = [(b'x-next-after', str(rows[-1].id).encode())] if len(rows) == limit else []
+    await send_json(send, 200, [serialize(row) for row in rows], headers)
+
+
+def live(*models):
+    # app.live(), which needs an app context
+    return tuple(model.deleted_at.is_(None) for model in models) if SOFT_DELETE else ()
+
+
+def grade_select():
+    return select(Grade.id, Student.name.label('student'), Course.name.label('course'), Grade.score) \
+        .join(Student, Grade.student_id == Student.id) \
+        .join(Course, Grade.course_id == Course.id) \
+        .where(*live(Grade))
+
+
+async def list_students(send, conn, args):
+    await paginate(send, conn, args, select(Student.id, Student.name).where(*live(Student)), Student.id,
+                   lambda row: row.name)
+
+
+async def list_courses(send, conn, args):
+    await paginate(send, conn, args, select(Course.id, Course.name).where(*live(Course)), Course.id,
+                   lambda row: row.name)
+
+
+async def list_grades(send, conn, args):
+    await paginate(send, conn, args, grade_select(), Grade.id, serialize_grade)
+
+
+async def student_detail(send, conn, args, id):
+    student = (await conn.execute(select(Student.name, Student.email, Student.gpa)
+                                  .where(Student.id == id, *live(Student)))).first()
+    if student is None:
+        raise not_found()
+    courses = await conn.execute(select(Course.name).join(student_course, student_course.c.course_id == Course.id)
+                                 .where(student_course.c.student_id == id, *live(Course)))
+    await send_json(send, 200, {
+        'name': student.name,
+        'email': student.email,
+        'courses': courses.scalars().all(),
+        'gpa': student.gpa
+    })
+
+
+async def course_detail(send, conn, args, id):
+    course = (await conn.execute(select(Course.name, User.username).join(User, Course.teacher_id == User.id)
+                                 .where(Course.id == id, *live(Course)))).first()
+    if course is None:
+        raise not_found()
+    students = await conn.execute(select(Student.name).join(student_course, student_course.c.student_id == Student.id)
+                                  .where(student_course.c.course_id == id, *live(Student)))
+    scores = await conn.execute(select(Grade.score).where(Grade.course_id == id, *live(Grade)))
+    await send_json(send, 200, {
+        'name': course.name,
+        'teacher': course.username,
+        'students': students.scalars().all(),
+        'grades': scores.scalars().all()
+    })
+
+
+async def grade_detail(send, conn, args, id):
+    grade = (await conn.execute(grade_select().where(Grade.id == id))).first()
+    if grade is None:
+        raise not_found()
+    await send_json(send, 200, serialize_grade(grade))
+
+
+# with the Flask endpoint each one stands in for, whose rate limit and metrics it shares,
+# and the tables each response is built from, as in the Flask app's @cached()
+READ_ROUTES = (
+    (re.compile(r'/students'), list_students, 'students', ('student',)),
+    (re.compile(r'/students/(\d+)'), student_detail, 'student_detail', ('student', 'enrollment', 'course', 'grade')),
+    (re.compile(r'/courses'), list_courses, 'courses', ('course',)),
+    (re.compile(r'/courses/(\d+)'), course_detail, 'course_detail', ('course', 'enrollment', 'student', 'grade')),
+    (re.compile(r'/grades'), list_grades, 'grades', ('grade', 'student', 'course')),
+    (re.compile(r'/grades/(\d+)'), grade_detail, 'grade_detail', ('grade', 'student', 'course')),
+)
+
+flask_asgi = WsgiToAsgi(flask_app)
+
+
+def observing(send, response):
+    # records the status and declared size of what actually goes out, after compression
+    async def send_observed(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            length = dict(message.get('headers', ())).get(b'content-length')
+            response['size'] = int(length) if length is not None else None
+        await send(message)
+
+    return send_observed
+
+
+def rate_limit(scope, endpoint, claims):
+    def caller():
+        if claims is not None:
+            return f'user:{claims["sub"]}'
+        return f'addr:{scope["client"][0] if scope.get("client") else None}'
+
+    wait = rate_limit_wait(flask_app.config, endpoint, caller)
+    if wait:
+        raise HTTPError(429, RATE_LIMITED, [(b'retry-after', str(math.ceil(wait)).encode())])
+
+
+async def serve(scope, send, handler, endpoint, tables, args, ids, sql):
+    headers = dict(scope['headers'])
+    try:
+        claims, denied = authenticate(headers), None
+    except HTTPError as error:
+        # a bad token is limited by address and answered after the limit, as in the Flask app
+        claims, denied = None, error
+    rate_limit(scope, endpoint, claims)
+    if denied is not None:
+        raise denied
+    async with engine.connect() as conn:
+        info = conn.sync_connection.info
+        info['sql_totals'] = sql
+        try:
+            etag, modified = validators((await conn.execute(versions_select(tables))).all())
+            extra_headers = [(name.lower().encode(), value.encode())
+                             for name, value in validator_headers(etag, modified).items()]
+            if not_modified(etag, modified, parse_etags(headers.get(b'if-none-match', b'').decode()),
+                            parse_date(headers.get(b'if-modified-since', b'').decode())):
+                await send({'type': 'http.response.start', 'status': 304, 'headers': extra_headers})
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            encoding = negotiate(parse_accept_header(headers.get(b'accept-encoding', b'').decode()))
+            await handler(compressing(send, encoding, extra_headers), conn, args, *ids)
+        finally:
+            # the connection goes back to the pool, later checkouts are not this request's
+            info.pop('sql_totals', None)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        for pattern, handler, endpoint, tables in READ_ROUTES:
+            match = pattern.fullmatch(scope['path'])
+            if match:
+                args = dict(parse_qsl(scope['query_string'].decode()))
+                if not args.keys() <= ASYNC_ARGS:
+                    break
+                started = time.perf_counter()
+                response = {'status': 500, 'size': None}
+                sql = [0, 0.0]
+                send = observing(send, response)
+                try:
+                    await serve(scope, send, handler, endpoint, tables, args,
+                                [int(group) for group in match.groups()], sql)
+                except HTTPError as error:
+                    await send_json(send, error.status, error.body, error.headers)
+                finally:
+                    metrics.observe(endpoint, 'GET', response['status'], time.perf_counter() - started,
+                                    sql[0], sql[1], response['size'])
+                return
+    await flask_asgi(scope, receive, send)
@@ -0,0 +1,364 @@
+"""Seed a synthetic dataset and measure every API route.
+
+    python bench.py --students 5000 --requests 200 --json bench_output.txt
+    python bench.py --mode gunicorn --workers 4 --concurrency 16 --login-storm 8
+    python bench.py --mode gunicorn --app asgi --sweep 1,4,16,64 --target-p99 50 --only students
+
+Client mode drives the Flask test client in-process and also counts SQL
+statements per request; gunicorn mode starts a local gunicorn and sends
+real HTTP requests from a thread pool. With --sweep each route is run at
+every listed concurrency and the report gives the highest one whose p99
+stayed within --target-p99, so the WSGI and ASGI apps can be compared.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('client', 'gunicorn'), default='client')
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--courses', type=int, default=50)
+    parser.add_argument('--teachers', type=int, default=10)
+    parser.add_argument('--courses-per-student', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--worker-class', default='sync', help='gunicorn worker class for --app wsgi')
+    parser.add_argument('--threads', type=int, default=1, help='threads per worker for --worker-class gthread')
+    parser.add_argument('--app', choices=('wsgi', 'asgi'), default='wsgi',
+                        help='serve wsgi:app, or asgi:app on uvicorn workers')
+    parser.add_argument('--preload', action='store_true', help='start gunicorn with --preload')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads in gunicorn mode')
+    parser.add_argument('--sweep', help='comma separated concurrency levels to run each route at')
+    parser.add_argument('--target-p99', type=float, default=100, help='p99 budget in ms for --sweep')
+    parser.add_argument('--login-storm', type=int, default=0, help='threads hammering /login during the run')
+    parser.add_argument('--no-cache', action='store_true', help='disable the response cache')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='keep the per-identity rate limiter on, every request is made with one token')
+    parser.add_argument('--accept-encoding', help='Accept-Encoding sent with every request, e.g. gzip or br')
+    parser.add_argument('--group-commit', type=float, default=0, help='group commit window in ms for grade writes')
+    parser.add_argument('--only', action='append', help='run only the named endpoints')
+    parser.add_argument('--json', help='write the report to this file')
+    return parser.parse_args(argv)
+
+
+def seed(m, app, args):
+    from werkzeug.security import generate_password_hash
+
+    with app.app_context():
+        m.db.drop_all()
+        m.db.create_all()
+        password = generate_password_hash('bench', m.hasher.method)
+        m.db.session.execute(m.User.__table__.insert(), [
+            {'username': f'teacher{i}', 'password': password, 'role': 'teacher'} for i in range(args.teachers)
+        ] + [{'username': 'bench', 'password': password, 'role': 'student'}])
+        m.db.session.execute(m.Course.__table__.insert(), [
+            {'name': f'Course {i}', 'teacher_id': i % args.teachers + 1} for i in range(args.courses)
+        ])
+        for start in range(0, args.students, 10000):
+            m.db.session.execute(m.Student.__table__.insert(), [
+                {'name': f'Student {i}', 'email': f'student{i}@example.com'}
+                for i in range(start, min(start + 10000, args.students))
+            ])
+            enrollments = [
+                {'student_id': i + 1, 'course_id': course_id}
+                for i in range(start, min(start + 10000, args.students))
+                for course_id in random.sample(range(1, args.courses + 1), min(args.courses_per_student, args.courses))
+            ]
+            m.db.session.execute(m.student_course.insert(), enrollments)
+            m.db.session.execute(m.Grade.__table__.insert(), [
+                dict(enrollment, score=round(random.uniform(40, 100), 1)) for enrollment in enrollments
+            ])
+        # throwaway rows for the write routes, see endpoints(): students in four blocks of n (deleted, owning a
+        # deleted grade, owning an updated grade, getting a new grade in course 1) and n courses to delete
+        n = throwaway_count(args)
+        m.db.session.execute(m.Student.__table__.insert(), [
+            {'name': f'Throwaway {i}', 'email': f'throwaway{i}@example.com'} for i in range(4 * n)
+        ])
+        m.db.session.execute(m.Course.__table__.insert(), [
+            {'name': f'Throwaway course {i}', 'teacher_id': 1} for i in range(n)
+        ])
+        m.db.session.execute(m.Grade.__table__.insert(), [
+            {'student_id': args.students + n + i + 1, 'course_id': 1, 'score': 70.0} for i in range(2 * n)
+        ])
+        m.recompute_gpa()
+        m.db.session.commit()
+        return m.create_access_token(identity=args.teachers + 1, additional_claims={'role': 'student'})
+
+
+def throwaway_count(args):
+    # rows a delete route uses up: one per request, on every --sweep level (see sweep())
+    if not args.sweep:
+        return args.requests
+    return sum(max(args.requests, int(level) * 10) for level in args.sweep.split(','))
+
+
+def endpoints(args):
+    counter = iter(range(10 ** 9))
+    grades = args.students * min(args.courses_per_student, args.courses)
+    n = throwaway_count(args)
+    deleted_students, deleted_courses, deleted_grades, graded = (iter(range(n)) for _ in range(4))
+    drawn = threading.local()
+
+    def any_id(limit):
+        return lambda: random.randint(1, limit)
+
+    def grade_id():
+        return random.randint(1, grades)
+
+    def draw(index):
+        # for a body that depends on the path: both are built on the thread making the request, path first
+        drawn.index = index
+        return index
+
+    def unique(prefix):
+        return f'{prefix}-{os.getpid()}-{next(counter)}'
+
+    return [
+        ('register', 'POST', lambda: '/register',
+         lambda: {'username': unique('bench'), 'password': 'bench', 'role': 'student'}),
+        ('login', 'POST', lambda: '/login', lambda: {'username': 'bench', 'password': 'bench'}),
+        ('students', 'GET', lambda: '/students', None),
+        ('students_page', 'GET', lambda: f'/students?after={random.randint(0, args.students)}', None),
+        ('students_large', 'GET', lambda: '/students?limit=1000', None),
+        ('student', 'GET', lambda: f'/students/{any_id(args.students)()}', None),
+        ('transcript', 'GET', lambda: f'/students/{any_id(args.students)()}/transcript', None),
+        ('create_student', 'POST', lambda: '/students',
+         lambda: {'name': 'Bench', 'email': f'{unique("bench")}@example.com'}),
+        ('search', 'GET', lambda: f'/search?q=student{any_id(args.students)()}', None),
+        ('search_name', 'GET', lambda: f'/search?q=stud+{any_id(args.students)()}', None),
+        ('courses', 'GET', lambda: '/courses', None),
+        ('course', 'GET', lambda: f'/courses/{any_id(args.courses)()}', None),
+        ('grades', 'GET', lambda: '/grades', None),
+        ('grades_large', 'GET', lambda: '/grades?limit=1000', None),
+        ('grades_filtered', 'GET',
+         lambda: f'/grades?course_id={any_id(args.courses)()}&min_score=90&sort=-score&fields=student_id,score', None),
+        ('grade', 'GET', lambda: f'/grades/{grade_id()}', None),
+        ('changes', 'GET', lambda: '/changes?limit=1000', None),
+        ('update_score', 'PATCH', lambda: '/grades/bulk',
+         lambda: [{'id': grade_id(), 'score': round(random.uniform(40, 100), 1)}]),
+        ('update_student', 'PUT', lambda: f'/students/{any_id(args.students)()}',
+         lambda: {'name': 'Bench', 'email': f'{unique("bench")}@example.com'}),
+        ('create_course', 'POST', lambda: '/courses', lambda: {'name': unique('Bench course'), 'teacher_id': 1}),
+        ('update_course', 'PUT', lambda: f'/courses/{any_id(args.courses)()}',
+         lambda: {'name': unique('Bench course'), 'teacher_id': 1}),
+        ('create_grade', 'POST', lambda: '/grades',
+         lambda: {'student_id': args.students + 3 * n + next(graded) + 1, 'course_id': 1, 'score': 75}),
+        ('update_grade', 'PUT', lambda: f'/grades/{grades + n + draw(random.randrange(n)) + 1}',
+         lambda: {'student_id': args.students + 2 * n + drawn.index + 1, 'course_id': 1,
+                  'score': round(random.uniform(40, 100), 1)}),
+        ('delete_grade', 'DELETE', lambda: f'/grades/{grades + next(deleted_grades) + 1}', None),
+        ('delete_student', 'DELETE', lambda: f'/students/{args.students + next(deleted_students) + 1}', None),
+        ('delete_course', 'DELETE', lambda: f'/courses/{args.courses + next(deleted_courses) + 1}', None),
+    ]
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summarize(latencies, errors, elapsed, queries=None):
+    report = {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+    if queries is not None:
+        report['queries_per_request'] = round(queries / len(latencies), 2)
+    return report
+
+
+def request_headers(token, args):
+    headers = {'Authorization': f'Bearer {token}'}
+    if args.accept_encoding:
+        headers['Accept-Encoding'] = args.accept_encoding
+    return headers
+
+
+def run_client(m, app, token, args, routes):
+    from sqlalchemy import event
+
+    statements = [0]
+    with app.app_context():
+        event.listen(m.db.engine, 'before_cursor_execute', lambda *_: statements.__setitem__(0, statements[0] + 1))
+
+    client = app.test_client()
+    headers = request_headers(token, args)
+    results = {}
+    for name, method, path, body in routes:
+        latencies, errors = [], 0
+        statements[0] = 0
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            begin = time.perf_counter()
+            response = client.open(path(), method=method, json=body() if body else None, headers=headers)
+            response.get_data()
+            latencies.append(time.perf_counter() - begin)
+            errors += response.status_code >= 500
+        results[name] = summarize(latencies, errors, time.perf_counter() - started, statements[0])
+    return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def http_request(port, method, path, body, headers):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        payload = json.dumps(body) if body is not None else None
+        conn.request(method, path, payload, dict(headers, **{'Content-Type': 'application/json'}))
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def wait_for(port, timeout=30):
+    # until a worker answers, not just until the master has bound the port
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            if http_request(port, 'GET', '/metrics', None, {}) == 200:
+                return time.perf_counter() - started
+        except OSError:
+            pass
+        time.sleep(0.02)
+    raise RuntimeError('gunicorn did not start')
+
+
+def login_storm(port, stop):
+    while not stop.is_set():
+        try:
+            http_request(port, 'POST', '/login', {'username': 'bench', 'password': 'bench'}, {})
+        except OSError:
+            pass
+
+
+def measure(port, route, concurrency, requests, headers):
+    _, method, path, body = route
+
+    def one(_):
+        begin = time.perf_counter()
+        status = http_request(port, method, path(), body() if body else None, headers)
+        return time.perf_counter() - begin, status >= 500
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        samples = list(pool.map(one, range(requests)))
+    return summarize([latency for latency, _ in samples], sum(error for _, error in samples),
+                     time.perf_counter() - started)
+
+
+def sweep(port, route, args, headers):
+    levels = []
+    for concurrency in sorted(int(level) for level in args.sweep.split(',')):
+        # enough requests per level for the p99 to mean something
+        levels.append(dict(measure(port, route, concurrency, max(args.requests, concurrency * 10), headers),
+                           concurrency=concurrency))
+    passing = [level['concurrency'] for level in levels if level['p99_ms'] <= args.target_p99 and not level['errors']]
+    return {'target_p99_ms': args.target_p99, 'max_concurrency': max(passing, default=0), 'levels': levels}
+
+
+def run_gunicorn(token, args, routes, env):
+    port = free_port()
+    app_target, worker_class = ('asgi:app', 'uvicorn.workers.UvicornWorker') if args.app == 'asgi' \
+        else ('wsgi:app', args.worker_class)
+    preload = ['--preload'] if args.preload else []
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '-k', worker_class,
+                               '--threads', str(args.threads), '-b', f'127.0.0.1:{port}', *preload, app_target],
+                              env=env)
+    stop = threading.Event()
+    storm = [threading.Thread(target=login_storm, args=(port, stop), daemon=True) for _ in range(args.login_storm)]
+    try:
+        print(f'gunicorn answered after {wait_for(port):.2f}s')
+        for thread in storm:
+            thread.start()
+        headers = request_headers(token, args)
+        results = {}
+        for route in routes:
+            if args.sweep:
+                results[route[0]] = sweep(port, route, args, headers)
+            else:
+                results[route[0]] = measure(port, route, args.concurrency, args.requests, headers)
+        return results
+    finally:
+        stop.set()
+        server.terminate()
+        server.wait()
+
+
+def print_sweep(results):
+    print(f'{"endpoint":<16}{"conc":>6}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"errors":>8}')
+    for name, row in results.items():
+        for level in row['levels']:
+            print(f'{name:<16}{level["concurrency"]:>6}{level["throughput_rps"]:>10}{level["p50_ms"]:>10}'
+                  f'{level["p99_ms"]:>10}{level["errors"]:>8}')
+        print(f'{name:<16}max concurrency at p99 <= {row["target_p99_ms"]} ms: {row["max_concurrency"]}')
+
+
+def print_report(results):
+    print(f'{"endpoint":<16}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"queries":>10}{"errors":>8}')
+    for name, row in results.items():
+        print(f'{name:<16}{row["throughput_rps"]:>10}{row["p50_ms"]:>10}{row["p95_ms"]:>10}{row["p99_ms"]:>10}'
+              f'{row.get("queries_per_request", "-"):>10}{row["errors"]:>8}')
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{os.path.join(workdir, "bench.db")}')
+    if args.no_cache:
+        env['CACHE_TTL'] = '0'
+    if not args.rate_limit:
+        env['RATE_LIMIT_ENABLED'] = '0'
+    if args.group_commit:
+        env['GROUP_COMMIT_WINDOW_MS'] = str(args.group_commit)
+    os.environ.update(env)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import app as m
+    from wsgi import app
+
+    random.seed(0)
+    token = seed(m, app, args)
+    routes = [route for route in endpoints(args) if not args.only or route[0] in args.only]
+    if args.mode == 'client':
+        results = run_client(m, app, token, args, routes)
+    else:
+        results = run_gunicorn(token, args, routes, env)
+
+    report = {'mode': args.mode, 'dataset': {'students': args.students, 'courses': args.courses,
+                                             'courses_per_student': args.courses_per_student},
+              'options': {key: value for key, value in vars(args).items() if key != 'json'},
+              'endpoints': results}
+    if args.sweep and args.mode == 'gunicorn':
+        print_sweep(results)
+    else:
+        print_report(results)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache:
+    """In-process LRU cache with a TTL, private to each gunicorn worker."""
+
+    def __init__(self, ttl=60, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires, value, tags)
+        self._tags = {}  # tag -> set of keys
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, tags=(), ttl=None):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, *tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SQLiteCache:
+    """Cache stored in a local SQLite file, shared by every worker on the box."""
+
+    PRUNE_EVERY = 100
+    IN_CLAUSE_SIZE = 500
+
+    def __init__(self, path, ttl=60, max_entries=10000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_entry '
+                         '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_tag '
+                         '(tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key))')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_tag_key ON cache_tag (key)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # SQLite connections must not cross a fork, a worker forked by `gunicorn --preload` opens its own
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute('SELECT value, expires FROM cache_entry WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, tags=()):
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM cache_tag WHERE key = ?', (key,))
+            conn.execute('INSERT OR REPLACE INTO cache_entry (key, value, expires) VALUES (?, ?, ?)',
+                         (key, json.dumps(value), time.time() + self.ttl))
+            conn.executemany('INSERT OR IGNORE INTO cache_tag (tag, key) VALUES (?, ?)',
+                             [(tag, key) for tag in tags])
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def invalidate(self, *tags):
+        if not tags:
+            return
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            keys = set()
+            for start in range(0, len(tags), self.IN_CLAUSE_SIZE):
+                chunk = tags[start:start + self.IN_CLAUSE_SIZE]
+                marks = ','.join('?' * len(chunk))
+                keys.update(key for key, in conn.execute(f'SELECT key FROM cache_tag WHERE tag IN ({marks})', chunk))
+            self._delete(conn, keys)
+
+    def prune(self):
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            expired = [key for key, in conn.execute('SELECT key FROM cache_entry WHERE expires < ?', (time.time(),))]
+            overflow = [key for key, in conn.execute('SELECT key FROM cache_entry ORDER BY expires LIMIT '
+                                                     'max(0, (SELECT count(*) FROM cache_entry) - ?)',
+                                                     (self.max_entries,))]
+            self._delete(conn, set(expired + overflow))
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM cache_entry')
+            conn.execute('DELETE FROM cache_tag')
+
+    @staticmethod
+    def _delete(conn, keys):
+        conn.executemany('DELETE FROM cache_entry WHERE key = ?', [(key,) for key in keys])
+        conn.executemany('DELETE FROM cache_tag WHERE key = ?', [(key,) for key in keys])
@@ -0,0 +1,55 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# in order of preference when the client takes several equally
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+COMPRESSIBLE = {'application/json', 'application/x-ndjson', 'text/csv', 'text/plain'}
+
+
+class BrotliCompressor:
+    """brotli.Compressor behind zlib's compress()/flush() interface."""
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def negotiate(accept_encodings):
+    # accept_encodings: a parsed Accept-Encoding header, werkzeug's request.accept_encodings or parse_accept_header()
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def compressor(encoding, levels):
+    if encoding == 'br':
+        return BrotliCompressor(levels['br'])
+    return zlib.compressobj(levels['gzip'], zlib.DEFLATED, 31)  # wbits 16 + 15: gzip header and trailer
+
+
+def compress(data, encoding, levels):
+    stream = compressor(encoding, levels)
+    return stream.compress(data) + stream.flush()
+
+
+def compress_stream(chunks, encoding, levels, charset='utf-8'):
+    # compresses as the chunks come, without flushing between them: output goes out whenever the compressor
+    # has a block ready, so memory stays flat and a long stream still starts arriving early
+    stream = compressor(encoding, levels)
+    try:
+        for chunk in chunks:
+            data = stream.compress(chunk.encode(charset) if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield stream.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
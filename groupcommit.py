@@ -0,0 +1,75 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class GroupCommitter:
+    """Runs small write units from many request threads in shared transactions, one commit per window."""
+
+    def __init__(self, connect, window=0.005, max_batch=256):
+        self.connect = connect
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def submit(self, unit, *args):
+        # blocks until the transaction holding this unit has committed, so callers only answer once it's durable
+        future = Future()
+        self._start().put((unit, args, future))
+        return future.result()
+
+    def _start(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # the committer thread doesn't survive a fork, start one per worker
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, args=(self._queue,), name='group-commit', daemon=True).start()
+                self._pid = os.getpid()
+            return self._queue
+
+    def _run(self, pending):
+        connection = None
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(pending.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if connection is not None and connection.invalidated:
+                connection.close()
+                connection = None
+            try:
+                if connection is None:
+                    connection = self.connect()
+            except Exception as error:
+                for _, _, future in batch:
+                    future.set_exception(error)
+                continue
+            self._commit(connection, batch)
+
+    @staticmethod
+    def _commit(connection, batch):
+        try:
+            with connection.begin():
+                results = [unit(connection, *args) for unit, args, _ in batch]
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0][2].set_exception(error)
+                return
+            # one unit failed and took the shared transaction with it, so give each its own to find out which
+            for unit, args, future in batch:
+                try:
+                    with connection.begin():
+                        result = unit(connection, *args)
+                    future.set_result(result)
+                except Exception as error:
+                    future.set_exception(error)
+            return
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,23 @@
+"""gunicorn settings, read from the working directory on start.
+
+    gunicorn --preload wsgi:app
+
+With --preload the master imports the app once and every worker is forked
+from it, so a new worker is serving in milliseconds instead of re-importing
+Flask, SQLAlchemy and flask-restx, and shares those pages copy-on-write.
+"""
+import gc
+
+
+def pre_fork(server, worker):
+    # moves everything the master built out of the collector's reach, so a worker's collections don't write to
+    # (and copy) the shared pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from app import db
+        from wsgi import app
+        with app.app_context():
+            db.engine.dispose(close=False)  # pooled connections are never shared with the master
@@ -0,0 +1,85 @@
+import fcntl
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashPoolBusy(Exception):
+    pass
+
+
+class SharedSlots:
+    """Counting semaphore shared by every process on the box, one flock()ed file per slot."""
+
+    def __init__(self, directory, count):
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, f'slot-{index}.lock') for index in range(count)]
+
+    def acquire(self):
+        # each open() is its own lock owner, so this works across threads as well as forked workers
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def release(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class PasswordHasher:
+    """Runs PBKDF2 on a bounded process pool so logins can't tie up request workers."""
+
+    def __init__(self, slot_dir, iterations=260000, workers=2, max_pending=2, timeout=10):
+        self.iterations = iterations
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = SharedSlots(slot_dir, max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    @property
+    def method(self):
+        return f'pbkdf2:sha256:{self.iterations}'
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return not pwhash.startswith(self.method + '$')
+
+    def _run(self, fn, *args):
+        # shed load instead of queueing once max_pending hashes are in flight across all workers,
+        # so a login storm can never occupy every sync worker
+        slot = self._slots.acquire()
+        if slot is None:
+            raise HashPoolBusy()
+        try:
+            future = self._pool().submit(fn, *args)
+        except BaseException:
+            self._slots.release(slot)
+            raise
+        # the slot is held until the pool process is done, also when the caller stops waiting for it
+        future.add_done_callback(lambda _: self._slots.release(slot))
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HashPoolBusy()
+
+    def _pool(self):
+        # each gunicorn worker gets its own pool, created after the fork
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(self.workers)
+                self._pid = os.getpid()
+            return self._executor
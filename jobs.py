@@ -0,0 +1,209 @@
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+
+class JobLost(Exception):
+    pass
+
+
+class JobQueue:
+    """Background jobs in a local SQLite file, run by `flask run-jobs` workers on the same box."""
+
+    PRUNE_EVERY = 60  # polls
+
+    def __init__(self, path, result_dir):
+        os.makedirs(result_dir, exist_ok=True)
+        self.path = path
+        self.result_dir = result_dir
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS job ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT NOT NULL, params TEXT NOT NULL, '
+                         'status TEXT NOT NULL, done INTEGER NOT NULL DEFAULT 0, total INTEGER, result TEXT, '
+                         'file TEXT, error TEXT, created_by TEXT, worker INTEGER, '
+                         'created_at REAL NOT NULL, started_at REAL, finished_at REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_job_status ON job (status, id)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # pool processes are forked from the worker, and web workers from a preloading gunicorn master
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def job_dir(self, id):
+        return os.path.join(self.result_dir, str(id))
+
+    def output_path(self, id, filename):
+        os.makedirs(self.job_dir(id), exist_ok=True)
+        return os.path.join(self.job_dir(id), filename)
+
+    @contextmanager
+    def open_output(self, id, filename):
+        # written under a name of its own and moved into place once complete, so an attempt that lost its
+        # job never mixes into the file of the attempt that took over
+        path = self.output_path(id, filename)
+        part = f'{path}.{os.getpid()}.part'
+        try:
+            with open(part, 'w', encoding='utf-8', newline='') as file:
+                yield file
+            os.replace(part, path)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+
+    def enqueue(self, type, params, created_by=None, inputs=None):
+        # inputs: filename -> file object, read to completion before the write lock is taken, so a slow upload
+        # never stalls the queue, then moved next to the job's results before a worker can see the job
+        staged = {}
+        try:
+            for filename, source in (inputs or {}).items():
+                fd, staged[filename] = tempfile.mkstemp(suffix='.part', dir=self.result_dir)
+                with open(fd, 'wb') as target:
+                    shutil.copyfileobj(source, target)
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                id = conn.execute('INSERT INTO job (type, params, status, created_by, created_at) '
+                                  'VALUES (?, ?, ?, ?, ?)',
+                                  (type, json.dumps(params), 'queued', created_by, time.time())).lastrowid
+                for filename, path in staged.items():
+                    os.replace(path, self.output_path(id, filename))
+        finally:
+            for path in staged.values():
+                if os.path.exists(path):
+                    os.remove(path)
+        return id
+
+    def get(self, id):
+        row = self._connect().execute('SELECT * FROM job WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    def claim(self, worker):
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute("SELECT id FROM job WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE job SET status = 'running', worker = ?, started_at = ? WHERE id = ?",
+                         (worker, time.time(), row[0]))
+        return self.get(row[0])
+
+    # progress(), finish() and fail() only apply while the job is still running under the claim it was handed
+    # out with; once it was requeued, e.g. after the worker was interrupted, progress() raises JobLost to stop
+    # the abandoned attempt
+    def progress(self, job, done, total=None):
+        updated = self._connect().execute("UPDATE job SET done = ?, total = coalesce(?, total) "
+                                          "WHERE id = ? AND status = 'running' AND worker = ? AND started_at = ?",
+                                          (done, total, job['id'], job['worker'], job['started_at'])).rowcount
+        if not updated:
+            raise JobLost(job['id'])
+
+    def finish(self, job, result, file=None):
+        self._connect().execute("UPDATE job SET status = 'done', result = ?, file = ?, finished_at = ? "
+                                "WHERE id = ? AND status = 'running' AND worker = ? AND started_at = ?",
+                                (json.dumps(result), file, time.time(), job['id'], job['worker'], job['started_at']))
+
+    def fail(self, job, error):
+        self._connect().execute("UPDATE job SET status = 'failed', error = ?, finished_at = ? "
+                                "WHERE id = ? AND status = 'running' AND worker = ? AND started_at = ?",
+                                (error, time.time(), job['id'], job['worker'], job['started_at']))
+
+    def requeue(self, worker=None):
+        # running jobs of the given worker, or of any worker process that is gone, start over from scratch
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            running = conn.execute("SELECT id, worker FROM job WHERE status = 'running'").fetchall()
+            ids = [id for id, pid in running if pid == worker or (worker is None and not process_alive(pid))]
+            conn.executemany("UPDATE job SET status = 'queued', done = 0, total = NULL, worker = NULL, "
+                             "started_at = NULL WHERE id = ?", [(id,) for id in ids])
+        return len(ids)
+
+    def prune(self, older_than):
+        # finished jobs and their files go once they are older_than seconds
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            ids = [id for id, in conn.execute("SELECT id FROM job WHERE status IN ('done', 'failed') "
+                                              "AND finished_at < ?", (time.time() - older_than,))]
+            conn.executemany('DELETE FROM job WHERE id = ?', [(id,) for id in ids])
+        for id in ids:
+            shutil.rmtree(self.job_dir(id), ignore_errors=True)
+        return len(ids)
+
+    def work(self, execute, processes, poll_interval, retention, initializer=None, initargs=()):
+        # claims jobs while the pool has a free process; execute(job) runs in a pool process and records
+        # the outcome itself. The pool forks so its processes inherit the app, its models and handlers.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        worker = os.getpid()
+        self.requeue()
+
+        def start_pool():
+            return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'),
+                                       initializer=initializer, initargs=initargs)
+
+        pool = start_pool()
+        running = {}  # future -> (job, the pool it was submitted to)
+        polls = 0
+        try:
+            while True:
+                while len(running) < processes:
+                    job = self.claim(worker)
+                    if job is None:
+                        break
+                    running[pool.submit(execute, job)] = job, pool
+                if running:
+                    finished, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(poll_interval)
+                    finished = ()
+                for future in finished:
+                    job, submitted_to = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        continue
+                    self.fail(job, f'{type(error).__name__}: {error}')
+                    if isinstance(error, BrokenProcessPool) and submitted_to is pool:
+                        # a pool process died, which fails every job still on that pool
+                        pool.shutdown(wait=False)
+                        pool = start_pool()
+                polls += 1
+                if polls % self.PRUNE_EVERY == 0:
+                    self.prune(retention)
+        except KeyboardInterrupt:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.requeue(worker)
+
+
+def process_alive(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,111 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestMetrics:
+    """Per-process request counters rendered in the Prometheus text format."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._latency = {}  # (endpoint, method) -> [bucket counts..., +Inf count, sum]
+        self._requests = Counter()  # (endpoint, method, status)
+        self._statements = Counter()  # endpoint
+        self._db_seconds = Counter()  # endpoint
+        self._response_bytes = Counter()  # endpoint
+
+    def observe(self, endpoint, method, status, seconds, statements, db_seconds, size):
+        with self._lock:
+            histogram = self._latency.setdefault((endpoint, method), [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[index] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+            self._requests[endpoint, method, status] += 1
+            self._statements[endpoint] += statements
+            self._db_seconds[endpoint] += db_seconds
+            if size is not None:
+                self._response_bytes[endpoint] += size
+
+    def render(self):
+        with self._lock:
+            lines = ['# HELP http_request_duration_seconds Time spent handling requests.',
+                     '# TYPE http_request_duration_seconds histogram']
+            for (endpoint, method), histogram in sorted(self._latency.items()):
+                labels = f'endpoint="{endpoint}",method="{method}"'
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram[-2]}')
+                lines.append(f'http_request_duration_seconds_sum{{{labels}}} {histogram[-1]}')
+                lines.append(f'http_request_duration_seconds_count{{{labels}}} {histogram[-2]}')
+
+            lines += ['# HELP http_requests_total Requests handled, by status.',
+                      '# TYPE http_requests_total counter']
+            for (endpoint, method, status), count in sorted(self._requests.items()):
+                lines.append(f'http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+
+            for name, help_text, values in (
+                    ('db_statements_total', 'SQL statements executed while handling requests.', self._statements),
+                    ('db_time_seconds_total', 'Time spent in SQL statements.', self._db_seconds),
+                    ('http_response_bytes_total', 'Response body bytes, excluding streamed responses.',
+                     self._response_bytes)):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                for endpoint, value in sorted(values.items()):
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {value}')
+            return '\n'.join(lines) + '\n'
+
+
+def collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class StackSampler:
+    """Samples the stacks of registered threads and folds them for flamegraph tools."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._active = {}  # thread ident -> Counter of folded stacks
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self, ident):
+        with self._lock:
+            if self._pid != os.getpid():
+                # the sampling thread doesn't survive a fork, start one per worker
+                threading.Thread(target=self._run, name='stack-sampler', daemon=True).start()
+                self._pid = os.getpid()
+            self._active[ident] = Counter()
+
+    def stop(self, ident):
+        with self._lock:
+            return self._active.pop(ident, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, stacks in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[collapse(frame)] += 1
+
+
+def write_folded(directory, name, stacks):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{name}.folded')
+    with open(path, 'w') as fh:
+        for stack, count in stacks.most_common():
+            fh.write(f'{stack} {count}\n')
+    return path
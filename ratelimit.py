@@ -0,0 +1,75 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+SLOT = struct.Struct('<Qdd')  # key fingerprint (0 = free), tokens left, last update as unix time
+
+
+class SharedTokenBuckets:
+    """Token buckets in a memory-mapped file, shared by every worker process on the box."""
+
+    PROBES = 8
+
+    def __init__(self, path, slots=65536):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._buckets = None
+
+    def take(self, key, rate, burst):
+        # returns 0 when a token was taken, otherwise the seconds until the bucket holds one again
+        fingerprint = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        with self._lock:
+            buckets = self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset = self._find(buckets, fingerprint)
+                stored, tokens, updated = SLOT.unpack_from(buckets, offset)
+                now = time.time()
+                if stored == fingerprint:
+                    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+                else:
+                    tokens = burst
+                if tokens >= 1:
+                    SLOT.pack_into(buckets, offset, fingerprint, tokens - 1, now)
+                    return 0
+                SLOT.pack_into(buckets, offset, fingerprint, tokens, now)
+                return (1 - tokens) / rate
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _find(self, buckets, fingerprint):
+        # open addressing over a few neighbouring slots; when they are all taken the least recently used
+        # bucket is recycled, which at worst hands a long-idle caller a full bucket again
+        start = fingerprint % self.slots
+        victim, oldest = None, None
+        for probe in range(self.PROBES):
+            offset = (start + probe) % self.slots * SLOT.size
+            stored, _, updated = SLOT.unpack_from(buckets, offset)
+            if stored == fingerprint or stored == 0:
+                return offset
+            if oldest is None or updated < oldest:
+                victim, oldest = offset, updated
+        return victim
+
+    def _open(self):
+        if self._pid != os.getpid():
+            # a descriptor inherited over fork shares its flock() with the parent, so each worker opens its own
+            if self._fd is not None:
+                self._buckets.close()
+                os.close(self._fd)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            size = self.slots * SLOT.size
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._fd = fd
+            self._buckets = mmap.mmap(fd, size)
+            self._pid = os.getpid()
+        return self._buckets
@@ -0,0 +1,26 @@
+import json
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def dumps(obj):
+        # numpy scalars are float subclasses, which orjson only takes with this option
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    loads = orjson.loads
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+    loads = json.loads
+
+
+def json_response(data, code=200, headers=None):
+    """Every JSON body goes through here, registered as the flask-restx representation."""
+    return Response(dumps(data), status=code, mimetype='application/json', headers=headers)
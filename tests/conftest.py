@@ -0,0 +1,36 @@
+import pytest
+from flask_jwt_extended import create_access_token
+
+from app import User, create_app, db
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    instance = tmp_path_factory.mktemp('instance')
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{instance / "test.db"}',
+        'RATE_LIMIT_ENABLED': False,
+        'CACHE_TTL': 0,
+    }, instance_path=str(instance))
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+@pytest.fixture(scope='session')
+def teacher(app):
+    # created directly, /register would spend a full password hash per test session
+    with app.app_context():
+        user = User(username='teacher', password='unused', role='teacher')
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+@pytest.fixture
+def client(app, teacher):
+    client = app.test_client()
+    with app.app_context():
+        token = create_access_token(identity=teacher, additional_claims={'role': 'teacher'})
+    client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    return client
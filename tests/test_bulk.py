@@ -0,0 +1,26 @@
+def test_bulk_create_rejects_non_finite_scores(client, teacher):
+    client.post('/students', json={'name': 'Bulk', 'email': 'bulk@example.com'})
+    student_id = client.get('/students?fields=id&sort=-id&limit=1').get_json()[0]['id']
+    client.post('/courses', json={'name': 'Bulk', 'teacher_id': teacher})
+    course_id = client.get('/courses?fields=id&sort=-id&limit=1').get_json()[0]['id']
+
+    response = client.post('/grades/bulk', data=f'student_id,course_id,score\n{student_id},{course_id},nan\n'
+                                                f'{student_id},{course_id},inf\n', content_type='text/csv')
+    assert response.status_code == 400
+    assert [error['message'] for error in response.get_json()['errors']] == \
+        ['Missing or invalid student_id, course_id or score'] * 2
+
+
+def test_bulk_update_rejects_non_finite_scores(client, teacher):
+    client.post('/students', json={'name': 'Rescored', 'email': 'rescored@example.com'})
+    student_id = client.get('/students?fields=id&sort=-id&limit=1').get_json()[0]['id']
+    client.post('/courses', json={'name': 'Rescored', 'teacher_id': teacher})
+    course_id = client.get('/courses?fields=id&sort=-id&limit=1').get_json()[0]['id']
+    client.post('/grades', json={'student_id': student_id, 'course_id': course_id, 'score': 80})
+    grade_id = client.get('/grades?fields=id&sort=-id&limit=1').get_json()[0]['id']
+
+    response = client.patch('/grades/bulk', json=[{'id': grade_id, 'score': 'nan'},
+                                                  {'student_id': student_id, 'course_id': course_id, 'score': 'inf'}])
+    assert response.status_code == 400
+    assert [error['message'] for error in response.get_json()['errors']] == \
+        ['Missing or invalid id, student_id, course_id or score'] * 2
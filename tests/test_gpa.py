@@ -0,0 +1,39 @@
+import json
+
+from app import Student, db, recompute_gpa
+
+
+def test_gpa_rounds_halves_to_even(app, client, teacher):
+    # 25 points over 8 credits is 3.125, which Python's round() takes to 3.12 and SQL's ROUND() to 3.13
+    client.post('/students', json={'name': 'Halves', 'email': 'halves@example.com'})
+    with app.app_context():
+        student_id = db.session.query(Student.id).filter(Student.email == 'halves@example.com').scalar()
+    for i, score in enumerate((95, 95, 95, 95, 85, 85, 85, 50)):
+        client.post('/courses', json={'name': f'Rounding {i}', 'teacher_id': teacher})
+        course_id = client.get('/courses?fields=id,name&sort=-id&limit=1').get_json()[0]['id']
+        assert client.post('/grades', json={'student_id': student_id, 'course_id': course_id,
+                                            'score': score}).status_code == 201
+    assert client.get(f'/students/{student_id}').get_json()['gpa'] == 3.12
+
+    with app.app_context():
+        recompute_gpa()
+        db.session.commit()
+    assert client.get(f'/students/{student_id}').get_json()['gpa'] == 3.12
+
+
+def test_gpa_rounded_on_every_path(app, client, teacher):
+    # 11 points over 3 credits, 3.666...
+    client.post('/students', json={'name': 'Thirds', 'email': 'thirds@example.com'})
+    with app.app_context():
+        student_id = db.session.query(Student.id).filter(Student.email == 'thirds@example.com').scalar()
+    for i, score in enumerate((95, 95, 85)):
+        client.post('/courses', json={'name': f'Thirds {i}', 'teacher_id': teacher})
+        course_id = client.get('/courses?fields=id,name&sort=-id&limit=1').get_json()[0]['id']
+        client.post('/grades', json={'student_id': student_id, 'course_id': course_id, 'score': score})
+
+    listed = [row['gpa'] for row in client.get('/students?fields=id,gpa&limit=100').get_json()
+              if row['id'] == student_id]
+    bulk = [json.loads(line)['gpa'] for line in client.get('/transcripts').get_data(as_text=True).splitlines()
+            if json.loads(line)['id'] == student_id]
+    assert listed == bulk == [client.get(f'/students/{student_id}').get_json()['gpa']] == [3.67]
+    assert client.get(f'/students/{student_id}/transcript').get_json()['gpa'] == 3.67
@@ -0,0 +1,16 @@
+import time
+
+import pytest
+
+from hashing import HashPoolBusy, PasswordHasher
+
+
+def test_timeout_sheds_and_keeps_the_slot(tmp_path):
+    hasher = PasswordHasher(str(tmp_path), workers=1, max_pending=1, timeout=0.2)
+    with pytest.raises(HashPoolBusy):
+        hasher._run(time.sleep, 1)
+    # the pool process is still busy with the abandoned call, so its slot is still taken
+    with pytest.raises(HashPoolBusy):
+        hasher._run(time.sleep, 0)
+    time.sleep(1.2)
+    assert hasher._run(time.sleep, 0) is None
@@ -0,0 +1,46 @@
+import io
+
+from flask_jwt_extended import create_access_token
+
+from app import User, db
+from jobs import JobQueue
+
+
+def test_jobs_are_private_to_their_creator(app, client):
+    job_id = client.post('/jobs/gpa_rebuild').get_json()['id']
+    assert client.get(f'/jobs/{job_id}').status_code == 200
+
+    with app.app_context():
+        other = User(username='other teacher', password='unused', role='teacher')
+        db.session.add(other)
+        db.session.commit()
+        token = create_access_token(identity=other.id, additional_claims={'role': 'teacher'})
+    client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    assert client.get(f'/jobs/{job_id}').status_code == 404
+    assert client.get(f'/jobs/{job_id}/result').status_code == 404
+
+
+class SlowUpload(io.BytesIO):
+    # another process writes to the queue while the upload is still arriving
+
+    def __init__(self, data, queue):
+        super().__init__(data)
+        self.queue = queue
+        self.claimed = []
+
+    def read(self, *args):
+        if not self.claimed:
+            self.claimed.append(self.queue.claim(1))
+        return super().read(*args)
+
+
+def test_upload_copied_outside_the_write_lock(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'), str(tmp_path / 'results'))
+    queue.enqueue('gpa_rebuild', {})
+    upload = SlowUpload(b'student_id,course_id,score\n1,1,90\n', JobQueue(queue.path, queue.result_dir))
+
+    id = queue.enqueue('grades_import', {'input': 'grades.csv'}, inputs={'grades.csv': upload})
+    assert upload.claimed[0]['type'] == 'gpa_rebuild'
+    with open(queue.output_path(id, 'grades.csv'), 'rb') as file:
+        assert file.read() == upload.getvalue()
+    assert sorted(path.name for path in (tmp_path / 'results').iterdir()) == [str(id)]
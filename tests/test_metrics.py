@@ -0,0 +1,19 @@
+import copy
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from app import db
+
+
+def test_failed_statement_leaves_connection_info_alone(app):
+    with app.app_context():
+        connection = db.session.connection()
+        before = copy.deepcopy(dict(connection.info))
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.execute(text('SELECT * FROM no_such_table'))
+        assert dict(connection.info) == before
+        db.session.rollback()
+
@@ -0,0 +1,35 @@
+import base64
+import json
+
+import pytest
+
+
+def cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+@pytest.mark.parametrize('after', [
+    'NQ==',  # 5, valid JSON that is not a list
+    cursor({'name': 'a', 'id': 1}),
+    cursor(['a']),
+    cursor([['a'], 1]),
+    'not base64!',
+    'bm90IGpzb24=',
+])
+def test_invalid_after_cursor_is_a_400(client, after):
+    response = client.get(f'/students?sort=name&after={after}')
+    assert response.status_code == 400
+    assert response.get_json() == {'message': 'Invalid after cursor'}
+
+
+def test_after_cursor_pages_through_sorted_listing(client):
+    for name in ('Cursor B', 'Cursor A', 'Cursor C'):
+        client.post('/students', json={'name': name, 'email': f'{name.split()[1]}@cursor.example.com'})
+    names, after = [], None
+    while True:
+        response = client.get('/students?sort=name&limit=2' + (f'&after={after}' if after else ''))
+        names += response.get_json()
+        after = response.headers.get('X-Next-After')
+        if after is None:
+            break
+    assert names == sorted(names) and {'Cursor A', 'Cursor B', 'Cursor C'} <= set(names)
@@ -0,0 +1,54 @@
+import pytest
+from sqlalchemy import event
+
+from app import Course, Grade, Student, db, student_course
+
+# statements per request, the table_version lookup of @cached() included; none of them may grow with the rows
+EXPECTED = {
+    '/grades': 2,
+    '/grades/1': 2,
+    '/students/1': 3,
+    '/courses/1': 4,
+}
+
+
+def add_rows(app, teacher, count):
+    # count more students and courses; student 1 takes every course, every student takes course 1
+    with app.app_context():
+        first_student = db.session.query(db.func.count(Student.id)).scalar() + 1
+        first_course = db.session.query(db.func.count(Course.id)).scalar() + 1
+        db.session.execute(Student.__table__.insert(), [
+            {'name': f'Student {i}', 'email': f'student{i}@example.com'}
+            for i in range(first_student, first_student + count)
+        ])
+        db.session.execute(Course.__table__.insert(), [
+            {'name': f'Course {i}', 'teacher_id': teacher} for i in range(first_course, first_course + count)
+        ])
+        pairs = [(1, course_id) for course_id in range(max(first_course, 2), first_course + count)] + \
+                [(student_id, 1) for student_id in range(first_student, first_student + count)]
+        db.session.execute(student_course.insert(), [{'student_id': s, 'course_id': c} for s, c in pairs])
+        db.session.execute(Grade.__table__.insert(), [{'student_id': s, 'course_id': c, 'score': 70} for s, c in pairs])
+        db.session.commit()
+
+
+def count_queries(app, client, path):
+    statements = []
+    with app.app_context():
+        engine = db.engine
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        response = client.get(path)
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    assert response.status_code == 200, response.data
+    return len(statements)
+
+
+@pytest.mark.parametrize('path', EXPECTED)
+def test_query_count_does_not_grow_with_rows(app, client, teacher, path):
+    counts = []
+    for count in (3, 30):
+        add_rows(app, teacher, count)
+        counts.append(count_queries(app, client, path))
+    assert counts == [EXPECTED[path]] * 2
@@ -0,0 +1,15 @@
+import app as app_module
+
+
+def test_truncated_candidates_are_flagged(client, monkeypatch):
+    for word in ('alpha', 'bravo', 'charlie', 'delta', 'echo'):
+        client.post('/students', json={'name': f'Truncation {word}', 'email': f'truncation.{word}@example.com'})
+    monkeypatch.setattr(app_module, 'SEARCH_CANDIDATES', 3)
+
+    response = client.get('/search?q=truncation&type=student')
+    assert len(response.get_json()) == 3
+    assert response.headers['X-Search-Truncated'] == 'true'
+
+    response = client.get('/search?q=truncation+echo&type=student')
+    assert [hit['name'] for hit in response.get_json()] == ['Truncation echo']
+    assert 'X-Search-Truncated' not in response.headers
@@ -0,0 +1,44 @@
+import pytest
+
+from app import Grade, Student, db
+
+
+@pytest.fixture
+def soft_delete(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'SOFT_DELETE', True)
+
+
+def created_id(client, path):
+    return client.get(f'{path}?fields=id&sort=-id&limit=1').get_json()[0]['id']
+
+
+def test_deleted_keys_can_be_taken_again(app, client, teacher, soft_delete):
+    for _ in range(2):
+        assert client.post('/students', json={'name': 'Again', 'email': 'again@example.com'}).status_code == 201
+        student_id = created_id(client, '/students')
+        assert client.post('/courses', json={'name': 'Again', 'teacher_id': teacher}).status_code == 201
+        course_id = created_id(client, '/courses')
+        assert client.delete(f'/students/{student_id}').status_code == 200
+        assert client.delete(f'/courses/{course_id}').status_code == 200
+    with app.app_context():
+        assert db.session.query(Student.id).filter(Student.deleted_at.isnot(None),
+                                                   Student.email.endswith('again@example.com')).count() == 2
+
+
+def test_grade_delete_tombstones(app, client, teacher, soft_delete):
+    client.post('/students', json={'name': 'Graded', 'email': 'graded@example.com'})
+    student_id = created_id(client, '/students')
+    client.post('/courses', json={'name': 'Graded', 'teacher_id': teacher})
+    course_id = created_id(client, '/courses')
+    grade = {'student_id': student_id, 'course_id': course_id, 'score': 95}
+
+    assert client.post('/grades', json=grade).status_code == 201
+    grade_id = created_id(client, '/grades')
+    assert client.delete(f'/grades/{grade_id}').status_code == 200
+    assert client.get(f'/grades/{grade_id}').status_code == 404
+    assert client.get(f'/students/{student_id}').get_json()['gpa'] is None
+    with app.app_context():
+        assert db.session.get(Grade, grade_id).deleted_at is not None
+
+    assert client.post('/grades', json=dict(grade, score=85)).status_code == 201
+    assert client.get(f'/students/{student_id}').get_json()['gpa'] == 3.0
@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+# seconds for a cold `import app`, measured at about 0.7 s on a 1-CPU box; importing must not build the app
+IMPORT_BUDGET = 1.5
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(code):
+    return subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+
+
+def test_import_builds_nothing():
+    assert run('import app; print(hasattr(app, "app"), app.cache, app.jobs)').split() == ['False', 'None', 'None']
+
+
+def test_import_time_budget():
+    code = 'import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)'
+    assert min(float(run(code)) for _ in range(3)) < IMPORT_BUDGET
@@ -0,0 +1,11 @@
+"""The app instance, built once on import.
+
+    gunicorn --preload wsgi:app
+    flask --app wsgi run-jobs
+
+Importing app.py only defines the models, resources and create_app();
+this module is what servers, the flask CLI and asgi.py load.
+"""
+from app import create_app
+
+app = create_app()